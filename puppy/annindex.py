@@ -0,0 +1,111 @@
+import os
+import hashlib
+import numpy as np
+from puppylog import getLogger
+from puppycache import atomicWrite
+
+log = getLogger('annindex')
+
+# 単語ベクトルの近似最近傍探索 (IVF)
+# 正規化したベクトルを k-means で nlist 個のリストに分けておき、
+# 近いリストを nprobe 個だけ調べる. nprobe を上げれば正確に, 下げれば速くなる
+#   PUPPY_ANN_MIN    これより候補が多い domain に索引を使う
+#   PUPPY_ANN_NPROBE 調べるリストの数
+# python annindex.py で word2vec を読み込み, 索引を前もって作っておける
+
+FORMAT = 1
+MIN_SIZE = int(os.environ.get('PUPPY_ANN_MIN', 10000))
+NPROBE = int(os.environ.get('PUPPY_ANN_NPROBE', 8))
+CHUNK = 4096
+
+
+def nearest(matrix, centroids):
+    # 各行に一番近い中心 (内積が最大) の番号
+    assign = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), CHUNK):
+        assign[start:start+CHUNK] = np.argmax(matrix[start:start+CHUNK] @ centroids.T, axis=1)
+    return assign
+
+
+def kmeans(matrix, k, iters=10, seed=0):
+    # 球面 k-means (ベクトルも中心も長さ 1)
+    rng = np.random.default_rng(seed)
+    centroids = np.array(matrix[rng.choice(len(matrix), k, replace=False)], dtype=np.float32)
+    for _ in range(iters):
+        assign = nearest(matrix, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, matrix)
+        norms = np.linalg.norm(sums, axis=1)
+        filled = norms > 0  # 空になったリストは前の中心のまま
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids, nearest(matrix, centroids)
+
+
+def wordsHash(words):
+    return hashlib.sha256('\n'.join(words).encode('utf-8')).hexdigest()
+
+
+class IVFIndex(object):
+    __slots__ = ['centroids', 'order', 'offsets', 'nprobe']
+
+    def __init__(self, centroids, order, offsets, nprobe=NPROBE):
+        self.centroids = centroids
+        self.order = order      # リストごとに並べた行番号
+        self.offsets = offsets  # リスト c は order[offsets[c]:offsets[c+1]]
+        self.nprobe = nprobe
+
+    def candidates(self, v, nprobe=None):
+        # v に近いリストに入っている行番号 (小さい順)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        near = np.argpartition(-(self.centroids @ v), nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.order[self.offsets[c]:self.offsets[c+1]] for c in near])
+        ids.sort()
+        return ids
+
+
+def build(matrix, nlist=None, iters=10, seed=0):
+    nlist = nlist or max(1, int(np.sqrt(len(matrix))))
+    centroids, assign = kmeans(matrix, min(nlist, len(matrix)), iters, seed)
+    order = np.argsort(assign, kind='stable').astype(np.int64)
+    offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+    return IVFIndex(centroids, order, offsets)
+
+
+def save(index, path, words):
+    try:
+        atomicWrite(path, lambda f: np.savez(f, format=FORMAT, words=wordsHash(words), centroids=index.centroids,
+                                             order=index.order, offsets=index.offsets))
+    except OSError as e:
+        log.warning('index not saved %s: %s', path, e)
+
+
+def load(path, words):
+    # 同じ単語 (同じ順番) で作った索引でなければ None
+    try:
+        with np.load(path) as data:
+            if int(data['format']) != FORMAT or str(data['words']) != wordsHash(words):
+                return None
+            return IVFIndex(data['centroids'], data['order'], data['offsets'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def domainIndex(matrix, words, path):
+    if len(words) < MIN_SIZE:
+        return None  # 全部調べても速い
+    index = load(path, words)
+    if index is None:
+        log.info('building ANN index for %d words (%s)', len(words), path)
+        index = build(matrix)
+        save(index, path, words)
+    return index
+
+
+if __name__ == "__main__":
+    os.environ['PUPPY_NLP_LOAD'] = 'sync'
+    import puppylog
+    puppylog.setup('INFO')
+    import nobuai  # 読み込むときに大きな domain の索引を作って保存する
+    print(nobuai.STATUS['state'])
+
+__package__ = 'annindex'
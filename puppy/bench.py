@@ -0,0 +1,194 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+from pathlib import Path
+import puppy
+import puppytypes as ts
+import nobuai as nlp
+
+# python bench.py -o report.json --baseline old.json
+# 構文解析, 変換 (conv), 型検査, puppyVMCode を別々に計る
+
+
+class Timer(object):
+    __slots__ = ['func', 'elapsed', 'calls', 'depth']
+
+    def __init__(self, func):
+        self.func = func
+        self.elapsed = 0.0
+        self.calls = 0
+        self.depth = 0  # 再帰呼び出しは一番外側だけ計る
+
+    def __call__(self, *args, **kw):
+        if self.depth > 0:
+            return self.func(*args, **kw)
+        self.depth += 1
+        self.calls += 1
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kw)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.depth -= 1
+
+    def reset(self):
+        self.elapsed = 0.0
+        self.calls = 0
+
+
+def install():
+    timers = {
+        'parse': Timer(puppy.parser),
+        'typecheck': Timer(ts.matchType),
+    }
+    puppy.parser = timers['parse']
+    ts.matchType = timers['typecheck']
+    return timers
+
+
+def measure(timers, source):
+    for t in timers.values():
+        t.reset()
+    nlp.PHRASE_CACHE.clear()  # 前の回で解釈した表現も毎回解釈し直す
+    start = time.perf_counter()
+    env, main = puppy.transpile(source, [])
+    transpiled = time.perf_counter()
+    puppy.puppyVMCode(env, main, '', [])
+    end = time.perf_counter()
+    parse = timers['parse'].elapsed
+    typecheck = timers['typecheck'].elapsed
+    return {
+        'parse': parse,
+        'conv': transpiled - start - parse - typecheck,
+        'typecheck': typecheck,
+        'vmcode': end - transpiled,
+        'total': end - start,
+        'errors': len(env['@@logs']),
+    }
+
+
+def corpus(root='data'):
+    for path in sorted(Path(root).glob('*/*/*/sample.py')):
+        with open(path) as f:
+            yield str(path), f.read()
+
+
+def statements(n):
+    lines = []
+    for i in range(n):
+        if i % 3 == 0:
+            lines.append(f'x{i} = {i} * 2 + 1')
+        elif i % 3 == 1:
+            lines.append(f'print(x{i-1})')
+        else:
+            lines.append(f'Circle({i % 1000}, 500, width=30, height=30)')
+    return '\n'.join(lines) + '\n'
+
+
+def nesting(depth):
+    lines = ['a = 0']
+    for i in range(depth):
+        indent = '    ' * i
+        lines.append(f'{indent}for x{i} in range(3):' if i % 2 == 0 else f'{indent}if a < {i}:')
+    lines.append('    ' * depth + 'a = a + 1')
+    return '\n'.join(lines) + '\n'
+
+
+PHRASES = ['赤い', 'よく跳ねる', '色は緑', 'サッカーボール', '動かない', '少し跳ねる']
+
+
+def phrases(n):
+    lines = []
+    for i in range(n):
+        p = PHRASES[i % len(PHRASES)]
+        lines.append(f'ボール({i % 1000}, 500, {p})')
+    return '\n'.join(lines) + '\n'
+
+
+def synthetic():
+    for n in (10, 100, 1000):
+        yield f'statements/{n}', statements(n)
+    for d in (2, 4, 8, 16):
+        yield f'nesting/{d}', nesting(d)
+    for n in (10, 100):
+        yield f'phrases/{n}', phrases(n)
+
+
+def run(programs, repeat):
+    timers = install()
+    results = {}
+    for name, source in programs:
+        samples = [measure(timers, source) for _ in range(repeat)]
+        result = {k: statistics.median(s[k] for s in samples) for k in samples[0]}
+        result['lines'] = source.count('\n') + 1
+        results[name] = result
+        print(f"{name:40} {result['total']*1000:10.3f}ms", file=sys.stderr)
+    return results
+
+
+def scaling(repeat, sizes=(1000, 2000, 5000, 10000)):
+    # 文の数に比例しているか (1文あたりの時間がほぼ一定か) を見る
+    timers = install()
+    rows = []
+    for n in sizes:
+        source = statements(n)
+        total = statistics.median(measure(timers, source)['total'] for _ in range(repeat))
+        rows.append((n, total, total / n))
+        print(f'{n:8} statements {total*1000:10.3f}ms {total/n*1e6:8.2f}us/stmt', file=sys.stderr)
+    return {
+        'sizes': [{'statements': n, 'total': total, 'perStatement': per} for n, total, per in rows],
+        'ratio': rows[-1][2] / rows[0][2],  # 1 に近ければ線形
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['total'], result['total']
+        if old > 0 and new > old * (1 + threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+
+def main():
+    cmd = argparse.ArgumentParser(description='puppy transpiler benchmark')
+    cmd.add_argument('-o', '--output', default='bench.json')
+    cmd.add_argument('--baseline', help='compare with a previous report')
+    cmd.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown (0.2 = 20%%)')
+    cmd.add_argument('--repeat', type=int, default=5)
+    cmd.add_argument('--scaling', action='store_true', help='check linear time up to 10,000 statements')
+    args = cmd.parse_args()
+    if args.scaling:
+        print(json.dumps(scaling(args.repeat), indent=2))
+        return
+
+    programs = list(corpus()) + list(synthetic())
+    report = {
+        'python': platform.python_version(),
+        'version': puppy.VERSION,
+        'grammar': puppy.GRAMMAR_HASH,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': args.repeat,
+        'results': run(programs, args.repeat),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(report['results'], baseline, args.threshold)
+        for name, old, new in regressions:
+            print(f'@regression {name} {old*1000:.3f}ms => {new*1000:.3f}ms', file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+__package__ = 'bench'
@@ -1,5 +1,8 @@
 from pathlib import Path
 import json
+from puppylog import getLogger
+
+log = getLogger('nlp')
 
 
 def getRootPath(subdir='data'):
@@ -14,7 +17,7 @@ def jsondec(x):
         try:
             return json.loads(x)
         except:
-            print('[JSON ERROR]', x)
+            log.warning('JSON error: %s', x)
             return {}
     return x
 
@@ -41,10 +44,10 @@ def load_KnowledgeBase(path):
                 if parent in KnowledgeBase:
                     defined = merge(KnowledgeBase[parent], defined)
                 else:
-                    print('undefined', parent)
+                    log.warning('undefined parent %s', parent)
             for key in map(lambda x: x.strip(), keys.split(',')):
                 if key in KnowledgeBase:
-                    print('redefined', key)
+                    log.info('redefined %s', key)
                 KnowledgeBase[key] = defined
 
 # path nlp_dict/color_dict.txt
@@ -75,7 +78,7 @@ def load_SimpleDict(path, property, suffix=None):
 def init_wordvec(path='nlp_dict/entity_vector.model.bin'):
     model_path = getRootPath(path)
     if not model_path.exists():
-        print('nobuai is not available')
+        log.warning('nobuai is not available (%s)', model_path)
         return lambda x, pinfo, property=None: None
     from gensim.models import KeyedVectors
     model = KeyedVectors.load_word2vec_format(
@@ -102,7 +105,7 @@ def init_wordvec(path='nlp_dict/entity_vector.model.bin'):
                 sim_max = sim
                 sim_w = w2
         if sim_w is not None:
-            print('@word2vec', w, sim_w, sim_max)
+            log.debug('word2vec %s %s %f', w, sim_w, sim_max)
             pinfo(f'「{w}」は{sim_w}(類似度{sim_max:.4})と解釈されました')
         return sim_w
 
@@ -113,7 +116,6 @@ load_KnowledgeBase('nlp_dict/matter_dict.txt')
 load_SimpleDict('nlp_dict/color_dict.txt', 'color', '色')
 #find_sim = init_wordvec('nlp_dict/entity_vector.model.bin')
 find_sim = init_wordvec('nlp_dict/word2vec.model.bin')
-print(KnowledgeBase['檸檬'])
 
 
 Empty = {}
@@ -167,7 +169,7 @@ def conv_phrase(phrase, pinfo, d):
     found = find_data(phrase, pinfo, None)
     #print('@調べる', phrase, found)
     if len(found) == 0:
-        print('@見つかりません', phrase)
+        log.debug('not found: %s', phrase)
     for key in found:
         d[key] = found[key]
 
@@ -180,7 +182,7 @@ def conv(*phrases):
     return d
 
 
-def conv2(phrase, pinfo=lambda x: print(x)):
+def conv2(phrase, pinfo=lambda x: log.debug('%s', x)):
     d = {}
     conv_phrase(phrase, pinfo, d)
     return d
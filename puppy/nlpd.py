@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import socket
+import socketserver
+from puppylog import getLogger
+
+log = getLogger('nlpd')
+
+# 辞書と word2vec を一つのプロセス (python nlpd.py) に持たせて、
+# コンパイルするプロセスからは Unix ソケットで問い合わせる
+# PUPPY_NLP_SOCKET=/tmp/puppy-nlp.sock で使う. つながらなければ自分で解釈する
+#
+# 一行一つの JSON
+#   -> {"phrases": ["赤い", "色は緑", ...]}
+#   <- {"results": [[{"color": "#ff0000"}, [pinfo のメッセージ, ...]], ...],
+#       "generation": 1, "version": "...", "pending": false}
+#   -> {"resolve": ["ふわふわ", ...], "property": "color", "k": 5}
+#   <- {"results": nobuai.resolve の結果, "generation": 1, "version": "...", "pending": false}
+#   -> {"reload": true}
+#   <- {"results": [], "started": true, "generation": 1, "version": "...", "pending": false}
+# version は答えた辞書とモデル (nobuai.Knowledge.version). コンパイル結果のキャッシュのキーに入れる
+
+SOCKET = os.environ.get('PUPPY_NLP_SOCKET')
+TIMEOUT = float(os.environ.get('PUPPY_NLP_TIMEOUT', 2.0))
+# キャッシュのキーを作る前に version を確かめる間隔 (秒, 0 なら毎回)
+# まとめて解釈したときの答えでも確かめたことになる
+REFRESH = float(os.environ.get('PUPPY_NLP_REFRESH', 1.0))
+# 最後に答えたときのデーモンの状態 (つながらなかったら version は None)
+REMOTE = {'generation': 0, 'version': None, 'pending': False, 'checked': None}
+
+
+def request(message, size, path=SOCKET, timeout=TIMEOUT):
+    # size 個の結果のリスト, 失敗したら None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(path)
+            s.sendall(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+            with s.makefile('rb') as f:
+                response = json.loads(f.readline())
+        results = response['results']
+        if len(results) != size:
+            raise ValueError(f'{len(results)} results for {size} phrases')
+    except (OSError, ValueError, KeyError) as e:
+        REMOTE['checked'] = time.monotonic()  # REFRESH 秒はつなぎ直さない
+        log.warning('nlpd not available (%s): %s', path, e)
+        REMOTE['version'] = None  # 自分で解釈する
+        return None
+    REMOTE['checked'] = time.monotonic()
+    REMOTE['generation'] = response.get('generation', 0)
+    REMOTE['version'] = response.get('version')
+    REMOTE['pending'] = response.get('pending', False)
+    return results
+
+
+def version(path=SOCKET, timeout=TIMEOUT, refresh=REFRESH):
+    # デーモンが読み込み直すと結果が変わるので, sourceHash の前に問い合わせる
+    # つながらなければ None (自分の辞書で解釈する)
+    if path is None:
+        return None
+    if REMOTE['checked'] is None or time.monotonic() - REMOTE['checked'] >= refresh:
+        request({'phrases': []}, 0, path, timeout)  # 空の問い合わせで状態だけ返ってくる
+    return REMOTE['version']
+
+
+def reload(path=SOCKET, timeout=TIMEOUT):
+    # デーモンに辞書を読み込み直させる. 届いたら True
+    if path is None:
+        return False
+    response = request({'reload': True}, 0, path, timeout)
+    return response is not None
+
+
+def resolve(phrases, path=SOCKET, timeout=TIMEOUT):
+    # {phrase: (option, messages)}, 失敗したら None
+    if path is None or len(phrases) == 0:
+        return None
+    results = request({'phrases': phrases}, len(phrases), path, timeout)
+    if results is None:
+        return None
+    return {phrase: (option, messages) for phrase, (option, messages) in zip(phrases, results)}
+
+
+def suggest(phrases, property=None, k=5, path=SOCKET, timeout=TIMEOUT):
+    # nobuai.resolve と同じもの, 失敗したら None
+    if path is None:
+        return None
+    return request({'resolve': phrases, 'property': property, 'k': k}, len(phrases), path, timeout)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        import nobuai as nlp
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                extra = {}
+                if 'reload' in message:
+                    results = []
+                    extra['started'] = nlp.start_reload()
+                elif 'resolve' in message:
+                    results = nlp.resolve(message['resolve'], message.get('property'), message.get('k', 5))
+                else:
+                    results = []
+                    for phrase in message['phrases']:
+                        messages = []
+                        option = nlp.conv2(phrase, messages.append)
+                        results.append([option, messages])
+            except (ValueError, KeyError, TypeError) as e:
+                self.wfile.write(json.dumps({'error': str(e)}).encode('utf-8') + b'\n')
+                continue
+            response = dict(extra, results=results, generation=nlp.STATUS['generation'],
+                            version=nlp.KNOWLEDGE.version, pending=nlp.pending())
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path):
+    import nobuai as nlp
+    nlp.start_loading()  # PUPPY_NLP_LOAD=lazy でもすぐに読み込む
+    # 辞書が書き換えられたら読み込み直す (PUPPY_NLP_WATCH 秒ごと, 0 なら {"reload": true} のときだけ)
+    interval = float(os.environ.get('PUPPY_NLP_WATCH', 5))
+    if interval > 0:
+        nlp.watch(interval, nlp.start_reload)
+    if os.path.exists(path):
+        os.unlink(path)  # 前に落ちたときのもの
+    with Server(path, Handler) as server:
+        os.chmod(path, 0o600)
+        log.info('nlpd listening on %s (%s)', path, nlp.STATUS['state'])
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    import puppylog
+    puppylog.setup()
+    serve(sys.argv[1] if len(sys.argv) > 1 else SOCKET or '/tmp/puppy-nlp.sock')
+
+__package__ = 'nlpd'
@@ -1,12 +1,51 @@
-from pathlib import Path
+import os
 import json
+import time
+import threading
+import pickle
+import hashlib
+from pathlib import Path
+from types import MappingProxyType
+from puppylog import getLogger
+import wordvec
+from puppycache import LRUCache, atomicWrite
+
+log = getLogger('nlp')
 
 
 def getRootPath(subdir='data'):
     return Path(__file__).parent.absolute() / subdir
 
 
-KnowledgeBase = {}
+def noSim(w, pinfo, property=None):
+    return None
+
+
+def noTopk(ws, k=5, property=None):
+    return [[] for _ in ws]
+
+
+class Knowledge(object):
+    # 辞書と word2vec の索引. 読み込み直すときは新しく作って、まとめて置き換える
+    __slots__ = ['base', 'suffixes', 'find_sim', 'find_topk', 'names', 'version']
+
+    def __init__(self, base=None, suffixes=None, vectors=None, version=''):
+        self.base = {} if base is None else base  # 単語 => 読み出し専用の辞書
+        self.suffixes = {} if suffixes is None else suffixes  # キーを後ろから並べたトライ ('' は終端)
+        self.find_sim, self.find_topk = (noSim, noTopk) if vectors is None else vectors
+        # 辞書の中身と word2vec の有無. 同じなら (別のプロセスでも) 同じ結果になる
+        self.version = version
+        self.names = None  # 辞書にある性質の名前 (properties で求める)
+
+    def properties(self):
+        if self.names is None:
+            self.names = frozenset(key for data in self.base.values() for key in data)
+        return self.names
+
+
+STATS = {'similarity': 0}  # model.similarity の呼び出し回数
+# conv2 の結果と pinfo のメッセージ (PUPPY_PHRASE_CACHE 個まで)
+PHRASE_CACHE = LRUCache(int(os.environ.get('PUPPY_PHRASE_CACHE', 10000)), sizeof=lambda entry: 1)
 
 
 def jsondec(x):
@@ -14,19 +53,31 @@ def jsondec(x):
         try:
             return json.loads(x)
         except:
-            print('[JSON ERROR]', x)
+            log.warning('JSON error: %s', x)
             return {}
     return x
 
 
-def merge(x, y='{}'):
+def merge(x, y={}):
     z = {}
     z.update(jsondec(x))
     z.update(jsondec(y))
     return z
 
 
-def load_KnowledgeBase(path):
+def define(key, value, knowledge):
+    if not isinstance(value, MappingProxyType):
+        value = MappingProxyType(value)
+    knowledge.base[key] = value
+    node = knowledge.suffixes
+    for c in reversed(key):
+        node = node.setdefault(c, {})
+    node[''] = True
+
+
+def load_KnowledgeBase(path, knowledge=None):
+    knowledge = KNOWLEDGE if knowledge is None else knowledge
+    KnowledgeBase = knowledge.base
     with open(path) as f:
         for line in f:
             if line.startswith('#'):
@@ -35,22 +86,24 @@ def load_KnowledgeBase(path):
             if pos == -1:
                 continue
             keys = line[0:pos].strip()
-            defined = line[pos:]
+            defined = MappingProxyType(jsondec(line[pos:]))
             if '<:' in keys:
                 keys, parent = map(lambda x: x.strip(), keys.split('<:'))
                 if parent in KnowledgeBase:
-                    defined = merge(KnowledgeBase[parent], defined)
+                    defined = MappingProxyType(merge(KnowledgeBase[parent], defined))
                 else:
-                    print('undefined', parent)
+                    log.warning('undefined parent %s', parent)
             for key in map(lambda x: x.strip(), keys.split(',')):
                 if key in KnowledgeBase:
-                    print('redefined', key)
-                KnowledgeBase[key] = defined
+                    log.info('redefined %s', key)
+                define(key, defined, knowledge)
 
 # path nlp_dict/color_dict.txt
 
 
-def load_SimpleDictionary(path, property, suffix=None):
+def load_SimpleDictionary(path, property, suffix=None, knowledge=None):
+    knowledge = KNOWLEDGE if knowledge is None else knowledge
+    KnowledgeBase = knowledge.base
     with open(path) as f:
         for line in f:
             if line.startswith('#'):
@@ -59,61 +112,374 @@ def load_SimpleDictionary(path, property, suffix=None):
                 key, value = line.split()
                 if suffix is not None and key.endswith(suffix):
                     key = key[:-len(suffix)]
-                value = f'{{"{property}": "{value}"}}'
+                value = {property: value}
                 if key in KnowledgeBase:
-                    KnowledgeBase[key] = merge(KnowledgeBase[key], value)
+                    define(key, merge(KnowledgeBase[key], value), knowledge)
                 else:
-                    KnowledgeBase[key] = value
+                    define(key, value, knowledge)
                 if suffix is not None:
                     key += suffix
                     if key in KnowledgeBase:
-                        KnowledgeBase[key] = merge(KnowledgeBase[key], value)
+                        define(key, merge(KnowledgeBase[key], value), knowledge)
                     else:
-                        KnowledgeBase[key] = value
+                        define(key, value, knowledge)
 
 
-def init_wordvec(path='nlp_dict/entity_vector.model.bin'):
+def open_model(path='nlp_dict/entity_vector.model.bin'):
     model_path = getRootPath(path)
-    if not model_path.exists():
-        print('nobuai is not available')
-        return lambda x, pinfo, property=None: None
-    from gensim.models import KeyedVectors
-    model = KeyedVectors.load_word2vec_format(
-        str(model_path), limit=500000, binary=True)
+    model = wordvec.load(model_path)  # 変換済みなら mmap で読む
+    if model is None:
+        if not model_path.exists():
+            log.warning('nobuai is not available (%s)', model_path)
+            return None
+        from gensim.models import KeyedVectors
+        log.info('loading %s (python wordvec.py convert %s makes it faster)', model_path, path)
+        model = KeyedVectors.load_word2vec_format(
+            str(model_path), limit=wordvec.LIMIT, binary=True)
+    return model
+
+
+def init_wordvec(model, KnowledgeBase, path):
+    # KnowledgeBase の単語から近いものを探す (find_sim, find_topk)
+    import numpy as np
+    import annindex
     base = [x for x in KnowledgeBase.keys() if x in model]
-    domains = {}
+    domains = {}  # property => (単語のリスト, 正規化したベクトルを並べた行列, 索引)
 
     def domain(property):
-        if property is None:
-            return base
         if not property in domains:
-            domains[property] = [
+            words = base if property is None else [
                 x for x in base if property in KnowledgeBase[x]]
+            if len(words) == 0:  # モデルにある単語がない (候補なし)
+                domains[property] = (words, None, None)
+                return domains[property]
+            matrix = np.array([model[x] for x in words], dtype=np.float32)
+            matrix = matrix.reshape(len(words), -1)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix = matrix / norms
+            # 大きな domain は近似最近傍探索の索引を使う
+            index = annindex.domainIndex(matrix, words, getRootPath(
+                f'nlp_dict/__pycache__/ann.{Path(path).stem}.{property or "_"}.npz'))
+            domains[property] = (words, matrix, index)
         return domains[property]
 
+    def similarities(w, property):
+        # 候補とのコサイン類似度を行列とベクトルの積一回で求める
+        # ids は sims の各値の行番号 (None なら全部の行)
+        words, matrix, index = domain(property)
+        v = np.asarray(model[w], dtype=np.float32)
+        norm = np.linalg.norm(v)
+        if norm == 0 or len(words) == 0:
+            return words, None, np.zeros(0, dtype=np.float32)
+        v = v / norm
+        if index is None:
+            STATS['similarity'] += len(words)
+            return words, None, matrix @ v
+        ids = index.candidates(v)
+        STATS['similarity'] += len(ids)
+        return words, ids, matrix[ids] @ v
+
     def find_from_model(w, pinfo, property=None):
         if w not in model:
             return None
-        sim_max = 0.0
-        sim_w = None
-        for w2 in domain(property):
-            sim = model.similarity(w, w2)
-            if sim > sim_max:
-                sim_max = sim
-                sim_w = w2
-        if sim_w is not None:
-            print('@word2vec', w, sim_w, sim_max)
-            pinfo(f'「{w}」は{sim_w}(類似度{sim_max:.4})と解釈されました')
+        words, ids, sims = similarities(w, property)
+        if len(sims) == 0:
+            return None
+        i = int(np.argmax(sims))  # 同じ値なら先の候補 (前と同じ)
+        if not sims[i] > 0.0:
+            return None
+        sim_w, sim_max = words[i if ids is None else ids[i]], float(sims[i])
+        log.debug('word2vec %s %s %f', w, sim_w, sim_max)
+        pinfo(f'「{w}」は{sim_w}(類似度{sim_max:.4})と解釈されました')
         return sim_w
 
-    return find_from_model
+    def top(words, ids, sims, k):
+        k = min(k, len(sims))
+        if k <= 0:
+            return []
+        best = np.argpartition(-sims, k - 1)[:k]
+        best = best[np.lexsort((best, -sims[best]))]
+        return [(words[i if ids is None else ids[i]], float(sims[i])) for i in best if sims[i] > 0.0]
+
+    def find_topk(ws, k=5, property=None):
+        # 単語ごとに [(単語, 類似度), ...] 類似度の高い順
+        # 索引がなければ, まとめて行列の積一回で求める
+        results = [[] for _ in ws]
+        found = [i for i, w in enumerate(ws) if w in model]
+        words, matrix, index = domain(property)
+        if len(found) == 0 or len(words) == 0 or k <= 0:
+            return results
+        queries = np.array([model[ws[i]] for i in found], dtype=np.float32)
+        queries = queries.reshape(len(found), -1)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        queries = queries / norms
+        if index is None:
+            scores = queries @ matrix.T
+            STATS['similarity'] += scores.size
+            for i, sims in zip(found, scores):
+                results[i] = top(words, None, sims, k)
+            return results
+        for i, q in zip(found, queries):
+            ids = index.candidates(q)
+            STATS['similarity'] += len(ids)
+            results[i] = top(words, ids, matrix[ids] @ q, k)
+        return results
+
+    if len(base) >= annindex.MIN_SIZE:  # 索引は読み込みのときに作っておく
+        properties = {key for data in KnowledgeBase.values() for key in data}
+        for property in [None] + sorted(properties):
+            try:
+                domain(property)
+            except Exception:  # 作れなかった domain は使うときに作り直す
+                log.exception('failed to build the domain of %s', property)
+    return find_from_model, find_topk
+
+
+# 読み込む辞書 (path, property, suffix). property が None なら load_KnowledgeBase
+DICTIONARIES = [
+    ('nlp_dict/matter_dict.txt', None, None),
+    ('nlp_dict/color_dict.txt', 'color', '色'),
+]
+SNAPSHOT_FORMAT = 1
+
+
+def snapshotPath(digest):
+    return Path('nlp_dict') / '__pycache__' / f'knowledge.{digest[:16]}.pickle'
+
+
+def dictionaryHash(dictionaries):
+    h = hashlib.sha256(f'{SNAPSHOT_FORMAT}:{dictionaries}'.encode())
+    for path, _, _ in dictionaries:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def load_snapshot(digest, knowledge):
+    # 辞書ファイルが変わっていなければ、前に読み込んだものを一度で読む
+    try:
+        with open(snapshotPath(digest), 'rb') as f:
+            version, saved, kb, suffixes = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return False
+    if version != SNAPSHOT_FORMAT or saved != digest:
+        return False
+    frozen = {}  # 同じ定義を共有していたキーは共有したままにする
+    for key, value in kb.items():
+        if id(value) not in frozen:
+            frozen[id(value)] = MappingProxyType(value)
+        knowledge.base[key] = frozen[id(value)]
+    knowledge.suffixes.update(suffixes)
+    return True
+
+
+def save_snapshot(digest, knowledge):
+    path = snapshotPath(digest)
+    plain = {}
+    for value in knowledge.base.values():
+        plain.setdefault(id(value), dict(value))
+    kb = {key: plain[id(value)] for key, value in knowledge.base.items()}
+    try:
+        atomicWrite(path, lambda f: pickle.dump((SNAPSHOT_FORMAT, digest, kb, knowledge.suffixes), f,
+                                                protocol=pickle.HIGHEST_PROTOCOL), stale='knowledge.*.pickle')
+    except OSError as e:
+        log.warning('snapshot not saved %s: %s', path, e)
+
+
+def load_dictionaries(dictionaries=DICTIONARIES):
+    # 新しい Knowledge に読み込む (置き換えるのは install)
+    knowledge = Knowledge()
+    digest = dictionaryHash(dictionaries)
+    knowledge.version = digest[:16]
+    if load_snapshot(digest, knowledge):
+        return knowledge
+    for path, property, suffix in dictionaries:
+        if property is None:
+            load_KnowledgeBase(path, knowledge)
+        else:
+            load_SimpleDictionary(path, property, suffix, knowledge)
+    save_snapshot(digest, knowledge)
+    return knowledge
+
+
+KNOWLEDGE = load_dictionaries()
+KnowledgeBase = KNOWLEDGE.base
+
+# word2vec のモデルは読み込みに時間がかかるので、別スレッドで読み込む
+# PUPPY_NLP_LOAD=background (既定) | lazy (最初に使うとき) | sync (import で待つ)
+# 読み込みが終わるまでは辞書だけで解釈する
+#MODEL = 'nlp_dict/entity_vector.model.bin'
+MODEL = 'nlp_dict/word2vec.model.bin'
+STATUS = {
+    'state': 'idle',  # idle, loading, ready, unavailable, failed
+    'model': MODEL,
+    'started': None,
+    'elapsed': None,
+    'error': None,
+    'generation': 0,  # モデルや辞書が変わると結果も変わるので、キャッシュのキーに入れる
+    'reloaded': None,
+    'reloadError': None,
+}
+LOADING = threading.Lock()
+SWAPPING = threading.Lock()  # KNOWLEDGE を置き換えるのは一度に一つ
+VECTORS = None  # 読み込んだ word2vec のモデル
+
+
+def find_sim(w, pinfo, property=None):
+    return KNOWLEDGE.find_sim(w, pinfo, property)
+
+
+def find_topk(ws, k=5, property=None):
+    return KNOWLEDGE.find_topk(ws, k, property)
+
+
+def withVectors(version):
+    return f'{version}+{Path(MODEL).stem}'
+
+
+def install(knowledge):
+    # コンパイル中のものは古い Knowledge をそのまま使う
+    global KNOWLEDGE, KnowledgeBase
+    KNOWLEDGE, KnowledgeBase = knowledge, knowledge.base
+    STATUS['generation'] += 1  # 結果が変わるので、キャッシュは使えない
+    PHRASE_CACHE.clear()
+
+
+def load_model():
+    global VECTORS
+    start = time.time()
+    STATUS.update(state='loading', started=start, error=None)
+    try:
+        model = open_model(MODEL)
+        if model is None:
+            STATUS.update(state='unavailable', elapsed=time.time() - start)
+            return
+        with SWAPPING:
+            VECTORS = model
+            base, suffixes = KNOWLEDGE.base, KNOWLEDGE.suffixes
+            install(Knowledge(base, suffixes, init_wordvec(model, base, MODEL), withVectors(KNOWLEDGE.version)))
+    except Exception as e:
+        log.exception('failed to load %s', MODEL)
+        STATUS.update(state='failed', error=str(e), elapsed=time.time() - start)
+        return
+    STATUS.update(state='ready', elapsed=time.time() - start)
+    log.info('word2vec ready (%.1fs)', STATUS['elapsed'])
+
+
+def reload_dictionaries():
+    # 辞書を読み込み直し, word2vec の索引も作り直してから置き換える
+    with SWAPPING:
+        start = time.time()
+        try:
+            knowledge = load_dictionaries()
+            if VECTORS is not None:
+                knowledge.find_sim, knowledge.find_topk = init_wordvec(VECTORS, knowledge.base, MODEL)
+                knowledge.version = withVectors(knowledge.version)
+        except Exception as e:
+            log.exception('failed to reload dictionaries')
+            STATUS['reloadError'] = str(e)
+            return False
+        install(knowledge)
+        STATUS.update(reloaded=time.time(), reloadError=None)
+        log.info('dictionaries reloaded (%d words, %.2fs)', len(knowledge.base), time.time() - start)
+    return True
+
+
+RELOADING = threading.Lock()  # 読み込み直しているあいだは取られている
 
 
-load_KnowledgeBase('nlp_dict/matter_dict.txt')
-load_SimpleDictionary('nlp_dict/color_dict.txt', 'color', '色')
-#find_sim = init_wordvec('nlp_dict/entity_vector.model.bin')
-find_sim = init_wordvec('nlp_dict/word2vec.model.bin')
-# print(KnowledgeBase)
+def start_reload():
+    # 別スレッドで読み込み直す. すでに読み込み直していれば何もしない (False)
+    if not RELOADING.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            reload_dictionaries()
+        finally:
+            RELOADING.release()
+
+    threading.Thread(target=run, name='nlp-reload', daemon=True).start()
+    return True
+
+
+def dictionaryTimes(dictionaries=DICTIONARIES):
+    times = []
+    for path, _, _ in dictionaries:
+        try:
+            times.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            times.append(None)  # 書き換えている途中
+    return times
+
+
+WATCH = {'interval': 0, 'reload': None, 'token': None}
+
+
+def watch(interval, reload=None):
+    # 辞書ファイルが書き換えられたら reload() で読み込み直す (interval 秒ごとに調べる)
+    token = object()
+    WATCH.update(interval=interval, reload=reload, token=token)
+
+    def loop():
+        last = dictionaryTimes()
+        while True:
+            time.sleep(interval)
+            if WATCH['token'] is not token:  # unwatch したか, 別の watch に替わった
+                return
+            now = dictionaryTimes()
+            if now != last and None not in now:
+                last = now
+                (reload or reload_dictionaries)()
+
+    threading.Thread(target=loop, name='nlp-watcher', daemon=True).start()
+
+
+def unwatch():
+    # 他のプロセスが読み込み直しを指示するときは自分では調べない
+    WATCH.update(interval=0, reload=None, token=None)
+
+
+def start_loading():
+    with LOADING:
+        if STATUS['state'] != 'idle':
+            return
+        STATUS['state'] = 'loading'
+    threading.Thread(target=load_model, name='nlp-loader', daemon=True).start()
+
+
+def pending():
+    # word2vec がまだ使えない (これから使えるようになる)
+    # lazy で読み込みを始めていないときは, 使うまで読み込まない
+    return STATUS['state'] == 'loading' or (STATUS['state'] == 'idle' and LOAD != 'lazy')
+
+
+def status():
+    return dict(STATUS, words=len(KNOWLEDGE.base), version=KNOWLEDGE.version, phrases=PHRASE_CACHE.stats())
+
+
+def restart_in_child():
+    # fork した子プロセスには読み込み中のスレッドがない
+    global LOADING, SWAPPING, RELOADING
+    LOADING = threading.Lock()
+    SWAPPING = threading.Lock()
+    RELOADING = threading.Lock()
+    if STATUS['state'] == 'loading':
+        STATUS['state'] = 'idle'
+        start_loading()
+    if WATCH['interval'] > 0:
+        watch(WATCH['interval'], WATCH['reload'])
+
+
+os.register_at_fork(after_in_child=restart_in_child)
+# nlpd を使うときは、つながらなかったときだけ自分で読み込む
+LOAD = os.environ.get('PUPPY_NLP_LOAD', 'lazy' if os.environ.get('PUPPY_NLP_SOCKET') else 'background')
+if LOAD == 'sync':
+    load_model()
+elif LOAD != 'lazy':
+    start_loading()
 
 
 Empty = {}
@@ -125,20 +491,46 @@ def suffix(w):
     return w
 
 
-def find_data(phrase: str, pinfo, property=None):
-    prefix = ''
-    w = phrase
-    while len(w) > 0:
-        if w in KnowledgeBase:
-            return merge(KnowledgeBase[w], find_data(suffix(prefix), pinfo, None))
-        # wordvec で 近似する
-        simw = find_sim(w, pinfo, property)
+def match_suffix(phrase, end, pinfo, property, knowledge):
+    # phrase[:end] の末尾にある一番長い単語を探す
+    node = knowledge.suffixes
+    longest = None
+    for i in range(end - 1, -1, -1):
+        node = node.get(phrase[i])
+        if node is None:
+            break
+        if '' in node:
+            longest = i
+    # それより長いところだけ wordvec で 近似する
+    for i in range(end if longest is None else longest):
+        simw = knowledge.find_sim(phrase[i:end], pinfo, property)
         if simw is not None:
-            return merge(KnowledgeBase[simw], find_data(suffix(prefix), pinfo, None))
-        # n-gramする
-        prefix += w[0]
-        w = w[1:]
-    return Empty
+            return i, simw
+    if longest is not None:
+        return longest, phrase[longest:end]
+    return None
+
+
+def find_data(phrase: str, pinfo, property=None):
+    # 後ろから単語を切り出していく. 前にある単語の方が優先される
+    knowledge = KNOWLEDGE  # 途中で読み込み直されても同じ辞書を使う
+    found = []
+    end = len(phrase)
+    while end > 0:
+        matched = match_suffix(phrase, end, pinfo, property, knowledge)
+        if matched is None:
+            break
+        end, key = matched
+        found.append(knowledge.base[key])
+        if end > 0 and phrase[end - 1] == 'の':
+            end -= 1
+        property = None
+    if len(found) == 0:
+        return Empty
+    data = {}
+    for x in found:
+        data.update(x)
+    return data
 
 
 def find_value(key, property, pinfo, default=None):
@@ -163,7 +555,7 @@ def conv_phrase(phrase, pinfo, d):
     # 特定の性質でない
     found = find_data(phrase, pinfo, None)
     if len(found) == 0:
-        print('@見つかりません', phrase)
+        log.debug('not found: %s', phrase)
     for key in found:
         d[key] = found[key]
 
@@ -177,9 +569,34 @@ def conv(*phrases):
 
 
 def conv2(phrase, pinfo=lambda x: None):
-    d = {}
-    conv_phrase(phrase, pinfo, d)
-    return d
+    # 同じ表現はどのプログラムにも出てくるので覚えておく
+    if STATUS['state'] == 'idle':
+        start_loading()
+    generation = STATUS['generation']
+    entry = PHRASE_CACHE.get(phrase)
+    if entry is None or entry[0] != generation:  # 古いモデルで解釈したもの
+        d, messages = {}, []
+        conv_phrase(phrase, messages.append, d)
+        entry = PHRASE_CACHE.put(phrase, (generation, d, tuple(messages)))
+    _, d, messages = entry
+    for msg in messages:  # 覚えていたときも同じメッセージを出す
+        pinfo(msg)
+    return dict(d)  # 呼び出し側が書き換えてもよいようにコピーする
+
+
+def resolve(phrases, property=None, k=5):
+    # エディタ向け: 解釈した結果と, 似ている辞書の単語を k 個ずつ
+    # 辞書にない性質は候補もないので, 索引 (domain) を作らない
+    known = property is None or property in KNOWLEDGE.properties()
+    results = []
+    for phrase in phrases:
+        messages = []
+        option = conv2(phrase if property is None else f'{property}は{phrase}', messages.append)
+        results.append({'phrase': phrase, 'option': option, 'messages': messages})
+    suggestions = find_topk([suffix(phrase) for phrase in phrases], k, property) if known else [[] for _ in phrases]
+    for result, found in zip(results, suggestions):
+        result['suggestions'] = [{'word': w, 'score': score} for w, score in found]
+    return results
 
 
 # main スクリプト
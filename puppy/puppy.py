@@ -1,11 +1,24 @@
+import os
 import sys
+import time
+import threading
 from collections import namedtuple
-from pegpy.tpeg import grammar, generate
+from pegpy.tpeg import generate
 import hashlib
+import logging
+from bisect import bisect_left
 import puppytypes as ts
 import nobuai as nlp
+import nlpd
+from puppycache import LRUCache
+from puppygrammar import loadGrammar
+from puppylog import getLogger
 
-peg = grammar('puppy2.tpeg')
+log = getLogger('compiler')
+
+VERSION = '0.1.0'
+
+peg, GRAMMAR_HASH = loadGrammar('puppy2.tpeg')
 parser = generate(peg)
 
 const = True
@@ -59,10 +72,13 @@ def Source(env: Env, t, out):
 
 def emitAutoYield(env: Env, out):
     if '@@yield' in env and '@local' not in env:
-        out.append(f"; yield {env['@@yield']};\n")
+        if env['@@compact']:
+            out.append(f";yield {env['@@yield']};")
+        else:
+            out.append(f"; yield {env['@@yield']};\n")
         del env['@@yield']
     else:
-        out.append('\n')
+        out.append(';' if env['@@compact'] else '\n')
 
 
 def ClassDecl(env: Env, t, out):
@@ -79,13 +95,13 @@ def ClassDecl(env: Env, t, out):
     for i, sub in enumerate(t):
         if i < argNum:
             continue
-        print(sub)
+        log.debug('class member %s', sub)
         conv(env, sub, out)
     return ts.Void
 
 
 def switchName(env: Env, name):
-    return localName(name) if '@local' in env else globalName(name)
+    return localName(env, name) if '@local' in env else globalName(name)
 
 
 def globalName(name):
@@ -98,7 +114,7 @@ def isGlobalName(name):
 
 def emitDeclName(env: Env, name, out):
     if '@local' in env:
-        jsname = localName(name)
+        jsname = localName(env, name)
         if name in env and env[name].target == jsname:
             out.append(f'{jsname} = ')
         else:
@@ -109,17 +125,15 @@ def emitDeclName(env: Env, name, out):
     return jsname
 
 
-UNICODE_NAME = {}
-
-
-def localName(name):
-    if name in UNICODE_NAME:
-        return UNICODE_NAME[name]
+def localName(env: Env, name):
+    names = env['@@names']  # コンパイルごとに _uu0 から振る
+    if name in names:
+        return names[name]
     for c in name:
         if ord(c) > 127:
-            uid = len(UNICODE_NAME)
-            UNICODE_NAME[name] = f'_uu{uid}/*{name}*/'
-            return UNICODE_NAME[name]
+            uid = len(names)
+            names[name] = f'_uu{uid}' if env['@@compact'] else f'_uu{uid}/*{name}*/'
+            return names[name]
     return name
 
 
@@ -138,7 +152,7 @@ def FuncDecl(env: Env, t, out):
                 out.append(pname)
             ty = ts.parseOf(p['type'], pwarn) if 'type' in p else ts.Type()
             types.append(ty)
-            lenv[pname] = Symbol(localName(pname), mutable, ty)
+            lenv[pname] = Symbol(localName(lenv, pname), mutable, ty)
         out.append(") => ")
         lenv['@local'] = types[0]  # return type
         env[name] = Symbol(jsname, mutable, tuple(types))
@@ -179,7 +193,7 @@ def FuncExpr(env: Env, t, out):
             else:
                 out.append(pname)
             types.append(ty)
-            lenv[pname] = Symbol(localName(pname), mutable, ty)
+            lenv[pname] = Symbol(localName(lenv, pname), mutable, ty)
         out.append(") => ")
         lenv['@local'] = types[0]  # return type
         conv(lenv, t['body'], out)
@@ -192,7 +206,7 @@ def Yield(env: Env, t, out):
     if '@local' in env:
         pwarn(env, t, '関数内で yield 文は使えません')
         return
-    out.append(f'yield {t.pos()[2]}')
+    out.append(f'yield {srcpos(env, t)[1]}')
     return ts.Void
 
 
@@ -340,17 +354,18 @@ def Infix(env: Env, t, out):
     else:
         perror(env, t['name'], f'{op}？ 未対応の演算子です。')
         return emitUndefined(env, t['name'], out)
-    out1 = []
-    out2 = []
-    ty1 = check(ts.binaryFirst(op), env, t['left'], out1)
-    ty2 = check(ts.binarySecond(op, ty1), env, t['right'], out2)
-    left,  right = ''.join(out1), ''.join(out2)
+    # 書式は両辺の型で決まるので、あとで埋める (入れ子が深くても連結し直さない)
+    head = len(out)
+    out.append('')
+    ty1 = check(ts.binaryFirst(op), env, t['left'], out)
+    mid = len(out)
+    out.append('')
+    ty2 = check(ts.binarySecond(op, ty1), env, t['right'], out)
     ty = ts.typeBinary(env, t['op'], op, ty1, ty2, perror)
     key = ts.typeKey(ty1, op)
-    if key in OPSFMT:
-        out.append(OPSFMT[key].format(left, right))
-    else:
-        out.append(OPSFMT[op].format(left, right))
+    fmt = OPSFMT[key] if key in OPSFMT else OPSFMT[op]
+    out[head], out[mid], tail = fmt.split('{}')
+    out.append(tail)
     return ty
 
 
@@ -459,7 +474,7 @@ def VarDecl(env: Env, t, out):
             ty = vari.types
             out.append(vari.target)
         elif '@local' in env:  # ローカルスコープなら
-            newvar = localName(name)
+            newvar = localName(env, name)
             out.append(f'var {newvar}')
         else:
             newvar = globalName(name)
@@ -685,8 +700,11 @@ def emitArguments(env, t, args, types, prev, out):
         for k in types[tidx]:
             if k not in used_keys:
                 emitOption(env, t, k, options[k], out, used_keys)
-        out.append(f"'trace': {trace(env, t)},")
-        out.append(f"'oid': {env['@@oid']},")
+        if env['@@compact']:
+            out.append(f"trace:{trace(env, t)},oid:{env['@@oid']},")
+        else:
+            out.append(f"'trace': {trace(env, t)},")
+            out.append(f"'oid': {env['@@oid']},")
         out.append('}')
     out.append(')')
 
@@ -709,8 +727,62 @@ def KeywordArgument(env, t, out, used_keys=None):
             out.append(',')
     return ts.Void
 
+def nlpConv(env, t, phrase):
+    phases = env['@@phases']
+    prefetched = env['@@nlp']
+    start = time.perf_counter()
+    if prefetched is None or phrase not in prefetched:  # nlpd でまとめて解釈していない
+        prefetched = None
+        # 集めそこねた表現も nlpd に聞く (自分で word2vec を読み込まない)
+        if nlpd.version() is not None:  # つながらなければ自分で解釈する
+            prefetched = nlpd.resolve([phrase])
+    if prefetched is not None:
+        option, messages = prefetched[phrase]
+        for msg in messages:
+            pinfo(env, t, msg)
+        option = dict(option)
+        pending = nlpd.REMOTE['pending']
+        version = nlpd.REMOTE['version']
+    else:
+        version = nlp.KNOWLEDGE.version
+        option = nlp.conv2(phrase, lambda x: pinfo(env, t, x))
+        pending = nlp.pending()  # lazy なら conv2 で読み込みが始まる
+        if nlp.KNOWLEDGE.version != version:  # 解釈している間に読み込み直した
+            version = 'mixed'
+    phases['nlp'] += time.perf_counter() - start
+    phases['nlpCalls'] += 1
+    # 解釈した辞書とモデル. キャッシュのキーと違えばキャッシュしない
+    if phases['knowledge'] == '':
+        phases['knowledge'] = version
+    elif phases['knowledge'] != version:
+        phases['knowledge'] = 'mixed'
+    if pending and not env['@@nlppending']:
+        env['@@nlppending'] = True
+        phases['nlpPending'] = 1  # このコンパイル結果はキャッシュしない
+        pinfo(env, t, '言語モデルを読み込み中です. 辞書にある言葉だけで解釈しました')
+    return option
+
+def collectPhrases(trees):
+    # nlpd に一度で問い合わせるために、nlpConv に渡す表現を前もって集める
+    phrases = set()
+    stack = [(t, None) for _, _, t in trees]
+    while len(stack) > 0:
+        t, target = stack.pop()
+        if t.tag == 'NLPSymbol':
+            phrase = str(t)
+            phrases.add(phrase if target is None else f'{target}は{phrase}')
+            continue
+        if t.tag == 'ApplyExpr' and t['name'].tag == 'NLPSymbol':
+            phrases.add(str(t['name']))  # checkNLPMatter
+        if t.tag == 'KeywordArgument':
+            name = str(t['name'])
+            target = KEYWORDS.get(name, name)
+        stack.extend((sub, target) for sub in t)
+    return sorted(phrases)
+
+
 def checkNLPMatter(env, name, t):
-    option = nlp.conv2(name, lambda x: pinfo(env, t, x))
+    option = nlpConv(env, t, name)
     if not 'shape' in option:
         pwarn(env, t, 'はっきりと物体の形状を指定してください')
         option['shape'] = 'Circle'
@@ -721,17 +793,16 @@ def checkNLPMatter(env, name, t):
 def NLPSymbol(env, t, out, used_keys=None):
     phrase = str(t)
     if '@target' in env:
-        option = nlp.conv2(f"{env['@target']}は{phrase}",
-                           lambda x: pinfo(env, t, x))
+        option = nlpConv(env, t, f"{env['@target']}は{phrase}")
         if len(option) == 1:
-            val = option[option.keys()[0]]
+            val = next(iter(option.values()))
             pinfo(env, t, f'{phrase}は{repr(val)}')
             return emitValue(env, val, out)
         else:
             pwarn(env, t, f'「{phrase}」は解釈できません')
             return emitUndefined(env, t, out)
     else:
-        option = nlp.conv2(phrase, lambda x: pinfo(env, t, x))
+        option = nlpConv(env, t, phrase)
         if len(option) == 0:
             pwarn(env, t, f'「{phrase}」は解釈できません')
             return ts.Void
@@ -746,7 +817,7 @@ def emitKey(env, t, key, out, used_keys):
         pwarn(env, t, f'{key}の重複！！．こちらは無視します')
         return False
     used_keys[key] = key
-    out.append("'" + key + "': ")
+    out.append("'" + key + ("':" if env['@@compact'] else "': "))
     return True
 
 def emitOption(env, t, key, value, out, used_keys):
@@ -791,7 +862,7 @@ def ForStmt(env: Env, t, out):
     out.append(')')
     ty = ts.typeOfSeq(ty)
     with Env(env) as env:
-        env[name] = Symbol(localName(name), True, ty)
+        env[name] = Symbol(localName(env, name), True, ty)
         env['inloop'] = True
         conv(env, t['body'], out)
     return ts.Void
@@ -801,6 +872,13 @@ INDENT = '\t'
 
 
 def Block(env: Env, t, out):
+    if env['@@compact']:
+        out.append('{')
+        for subtree in t:
+            conv(env, subtree, out)
+            emitAutoYield(env, out)
+        out.append('}')
+        return ts.Void
     out.append('{\n')
     indent = env['@indent']
     nested = INDENT + indent
@@ -827,7 +905,7 @@ def conv(env: Env, t, out):
         return func[t.tag](env, t, out)
     else:
         perror(env, t, f'未実装のコード{t.tag}です。')
-        print('@Debug[conv]', str(t), t)
+        log.debug('conv: unknown tag %s %s', t.tag, t)
         out.append('undefined')
         return ts.Type()
 
@@ -871,10 +949,14 @@ def set_World(env, t, options):
 def check(ret, env, t, out, msg=None):
     vat = conv(env, t, out)
     if ret is None or vat is None:
-        print('@DEBUG[check]', str(t), ret, vat)
+        log.debug('check: %s %s %s', t, ret, vat)
         return vat
-    if not ts.matchType(ret, vat):
-        print('@TypeError', ts.strType(ret), ts.strType(vat))
+    start = time.perf_counter()
+    matched = ts.matchType(ret, vat)
+    env['@@phases']['typecheck'] += time.perf_counter() - start
+    if not matched:
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('type error: %s %s', ts.strType(ret), ts.strType(vat))
         if msg != None:
             perror(env, t, msg)
         else:
@@ -884,53 +966,205 @@ def check(ret, env, t, out, msg=None):
     return vat
 
 
+def lineTable(inputs):
+    # 改行の位置
+    nl = b'\n' if isinstance(inputs, bytes) else '\n'
+    table = []
+    pos = inputs.find(nl)
+    while pos != -1:
+        table.append(pos)
+        pos = inputs.find(nl, pos + 1)
+    return table, len(inputs)
+
+
+def srcpos(env, t):
+    # t.pos() は毎回先頭から数え直すので、改行の位置表を二分探索する
+    # 分割してパースした場合は、行番号と位置をずらす
+    table, size = env['@@linetable']
+    spos = t.spos
+    end = spos + 1 if size > spos else spos
+    n = bisect_left(table, end)
+    last = table[n-1] if n > 0 else -1
+    return spos + env['@@posoffset'], n + 1 + env['@@lineoffset'], end - last - 2
+
+
+# 大きなプログラム (PUPPY_LARGE_PROGRAM 行以上) では、一回のコンパイルで出すメッセージを
+# エラーと警告, info でそれぞれ PUPPY_MAX_LOGS 件までにする
+LARGE_PROGRAM = int(os.environ.get('PUPPY_LARGE_PROGRAM', 2000))
+MAX_LOGS = int(os.environ.get('PUPPY_MAX_LOGS', 100))
+LOG_GROUP = {'error': 'problem', 'warning': 'problem', 'info': 'info'}
+LOG_NAMES = {'error': 'エラー', 'warning': '警告', 'info': 'メッセージ'}
+
+
+def span(t):
+    # str(t) で部分木の文字列を作らずに, 位置から長さを求める (bytes なら文字数に直す)
+    if isinstance(t.inputs, bytes):
+        return len(t.inputs[t.spos:t.epos].decode('utf-8', 'replace'))
+    return t.epos - t.spos
+
+
+def plog(env, kind, t, msg):
+    if env['@@large']:
+        counts = env['@@logcounts']
+        group = LOG_GROUP[kind]
+        if counts.get(group, 0) >= MAX_LOGS:
+            # 最初に出さなかったところに、あとでまとめて件数を出す
+            dropped = env['@@dropped']
+            if kind not in dropped:
+                dropped[kind] = [0, *srcpos(env, t), span(t)]
+            dropped[kind][0] += 1
+            return
+        counts[group] = counts.get(group, 0) + 1
+    pos, raw, col = srcpos(env, t)
+    env['@@logs'].append((kind, pos, raw, col, msg, span(t)))
+
+
 def perror(env, t, msg):
-    _, pos, raw, col = t.pos()
-    env['@@logs'].append(('error', pos, raw, col, msg, len(str(t))))
+    plog(env, 'error', t, msg)
 
 
 def pwarn(env, t, msg):
-    _, pos, raw, col = t.pos()
-    env['@@logs'].append(('warning', pos, raw, col, msg, len(str(t))))
+    plog(env, 'warning', t, msg)
 
 
 def pinfo(env, t, msg):
-    _, pos, raw, col = t.pos()
-    env['@@logs'].append(('info', pos, raw, col, msg, len(str(t))))
+    plog(env, 'info', t, msg)
+
+
+def closeLogs(env):
+    logs = env['@@logs']
+    for kind, (n, pos, raw, col, length) in env['@@dropped'].items():
+        logs.append((kind, pos, raw, col, f'他に {n} 件の{LOG_NAMES[kind]}があります', length))
 
 
 def trace(env, t):
     lines = env['@@lines']
-    linenum = t.pos()[2]
-    if not linenum in lines:
+    index = env['@@lineindex']
+    linenum = srcpos(env, t)[1]
+    if not linenum in index:
+        index[linenum] = len(lines)
         lines.append(linenum)
-    return f'puppy.ln({lines.index(linenum)})'
-
-
-def transpile(s, errors=[]):
-    t = parser(s)
-    # STDLOG.dump(t)  # debug
-    env = Env(BUILDIN.copy())
-    env['@@logs'] = errors
-    env['@@lines'] = []
-    env['@@lives'] = []
-    env['@indent'] = ''
-    if t.tag == 'err':
-        env['@@world'] = {}
-        perror(env, t, '構文エラーです. 文法通り書けているか確認しましょう')
-        return env, ''
-    # start transpile
-    env['@@world'] = WORLD.copy()
-    env['@@oid'] = 1
-    out = []
-    conv(env, t, out)
-    return env, ''.join(out)
+    return f'puppy.ln({index[linenum]})'
+
+# Incremental
+
+
+# 文の頭が字下げされていない行は、新しいトップレベル文になる
+INDENTED = ('', ' ', '\t', '\r', '\u3000')
+CONTINUED = ('else', 'そうでなければ', '#')
+
+
+def splitSource(s):
+    chunks = []
+    lines = s.split('\n')
+    start, pos, startpos = 0, 0, 0
+    stmt = False
+    for i, line in enumerate(lines):
+        if line[:1] not in INDENTED and not line.startswith(CONTINUED):
+            if stmt:
+                chunks.append((start, startpos, '\n'.join(lines[start:i]) + '\n'))
+                start, startpos = i, pos
+            stmt = True
+        pos += len(line) + 1
+    chunks.append((start, startpos, '\n'.join(lines[start:])))
+    return chunks
+
+
+# トップレベル文ごとのパース結果 (PUPPY_PARSE_CACHE 文まで)
+PARSE_CACHE = LRUCache(int(os.environ.get('PUPPY_PARSE_CACHE', 4096)), sizeof=lambda t: 1)
+
+
+def parseChunks(s):
+    trees = []
+    for line, pos, chunk in splitSource(s):
+        t = PARSE_CACHE.get(chunk)
+        if t is None:
+            t = PARSE_CACHE.put(chunk, parser(chunk))
+        if t.tag == 'err':  # 分割がまずいかもしれないので、全体をパースし直す
+            return [(0, 0, parser(s))]
+        trees.append((line, pos, t))
+    return trees
+
+
+def newPhases():
+    # 各段階にかかった時間 (秒) と NLP の呼び出し回数, 解釈した辞書とモデル (knowledge)
+    return {'parse': 0.0, 'conv': 0.0, 'typecheck': 0.0, 'nlp': 0.0, 'vmcode': 0.0,
+            'nlpCalls': 0, 'similarityCalls': 0, 'nlpPending': 0, 'knowledge': ''}
+
+
+def transpile(s, errors=None, incremental=False, compact=False, phases=None):
+    # コンパイルの状態は全て env の中 ('@@'で始まるキー) に置く
+    phases = newPhases() if phases is None else phases
+    with ts.typeScope() as types:  # 型変数はコンパイルごと
+        start = time.perf_counter()
+        trees = parseChunks(s) if incremental else [(0, 0, parser(s))]
+        phases['parse'] += time.perf_counter() - start
+        # STDLOG.dump(t)  # debug
+        env = Env(BUILDIN.copy())
+        env['@@logs'] = [] if errors is None else errors
+        env['@@types'] = types
+        env['@@names'] = {}
+        env['@@compact'] = compact  # 空白やコメントを出さない
+        env['@@lines'] = []
+        env['@@lineindex'] = {}
+        env['@@lives'] = []
+        env['@@large'] = s.count('\n') >= LARGE_PROGRAM  # メッセージの数を制限する
+        env['@@logcounts'] = {}
+        env['@@dropped'] = {}  # kind => [件数, 最初の位置...]
+        env['@@phases'] = phases
+        env['@@nlppending'] = False  # 辞書だけで解釈したことを知らせたか
+        env['@indent'] = ''
+        for line, pos, t in trees:
+            if t.tag == 'err':
+                env['@@world'] = {}
+                env['@@lineoffset'] = line
+                env['@@posoffset'] = pos
+                env['@@linetable'] = lineTable(t.inputs)
+                perror(env, t, '構文エラーです. 文法通り書けているか確認しましょう')
+                closeLogs(env)
+                return env, ''
+        # start transpile
+        env['@@world'] = WORLD.copy()
+        env['@@oid'] = 1
+        env['@@nlp'] = None
+        if nlpd.SOCKET is not None:
+            start = time.perf_counter()
+            env['@@nlp'] = nlpd.resolve(collectPhrases(trees))
+            phases['nlp'] += time.perf_counter() - start
+        out = []
+        start = time.perf_counter()
+        inner = phases['typecheck'] + phases['nlp']
+        similarity = nlp.STATS['similarity']
+        for line, pos, t in trees:
+            env['@@lineoffset'] = line
+            env['@@posoffset'] = pos
+            env['@@linetable'] = lineTable(t.inputs)
+            conv(env, t, out)
+        # conv の時間には型検査と NLP の時間を含めない
+        inner = phases['typecheck'] + phases['nlp'] - inner
+        phases['conv'] += time.perf_counter() - start - inner
+        phases['similarityCalls'] += nlp.STATS['similarity'] - similarity
+        closeLogs(env)
+        return env, ''.join(out)
 
 # Live
 
 
-prev_lives = []
-prev_code = ''
+class Live(object):
+    __slots__ = ['code', 'lives', 'lock']
+
+    def __init__(self):
+        self.code = ''   # 前回のコード
+        self.lives = []  # 前回のライブ値
+        self.lock = threading.Lock()  # 同じセッションのコンパイルは一度に一つ
+
+    def __getstate__(self):
+        # ワーカのプロセスに送るときはロックを除く
+        return (self.code, self.lives)
+
+    def __setstate__(self, state):
+        self.code, self.lives = state
+        self.lock = threading.Lock()
 
 
 def hasErrors(env):
@@ -941,27 +1175,24 @@ def hasErrors(env):
 
 
 def diffCode(prev, cur):
+    if prev == '':  # セッションの最初は差分がない
+        return ''
     prev = prev.split('\n')
     cur = cur.split('\n')
     plen, clen = len(prev)-1, len(cur)-1  # 最後は空行
-    print('@diff1', plen, clen)
     if plen >= clen:
         return ''
-    print('@prev', prev)
-    print('@cur', cur)
     for i in range(plen):
         if prev[i] != cur[i]:
-            print('@', i, '\n', prev[i], '\n', cur[i])
+            log.debug('diff: line %d changed', i)
             return ''
     nstart, nend = plen, clen
-    print('@diff2', nstart, nend)
     for nstart in range(plen, -1, -1):
         if not cur[nstart].startswith('\t'):
             break
-    print('@diff3', nstart, nend)
     diffcode = '\n'.join(cur[nstart:nend])
     diffcode = diffcode.replace('; yield', '; //yield')
-    print('@diffcode', diffcode)
+    log.debug('diff: lines %d-%d %s', nstart, nend, diffcode)
     return diffcode
 
 
@@ -980,26 +1211,32 @@ def diffLives(prev, cur):
                 lives.append(f'\t[{c[0]}, "{c[1]}", {c[2]}, {p[2]}],\n')
         else:
             lives.append(f'\t[{c[0]}, "{c[1]}", {c[2]}, null],\n')
-    print('@@lives', lives)
+    log.debug('lives: %s', lives)
     if len(lives) > 1:
         lives = []
     return lives
 
 
+def diagnostic(e):
+    row = e[2]-2 if e[3] == -1 else e[2]-1
+    return {'type': e[0], 'row': row, 'col': e[3], 'len': e[5], 'text': e[4]}
+
+
 def puppyVMCode(env, main, diffcode, lives):
+    if env['@@compact']:
+        return compactVMCode(env, main, diffcode, lives)
     W = env['@@world']
     world = [f"     '{k}': {W[k]}," for k in W]
     world = '\n'.join(world)
     error = []
-    for e in env['@@logs']:
-        row = e[2]-2 if e[3] == -1 else e[2]-1
+    for e in map(diagnostic, env['@@logs']):
         error.append(f'''
         {{
-            'type': '{e[0]}',
-            'row': {row},
-            'col': {e[3]},
-            'len': {e[5]},
-            'text': {repr(e[4])}
+            'type': '{e['type']}',
+            'row': {e['row']},
+            'col': {e['col']},
+            'len': {e['len']},
+            'text': {repr(e['text'])}
         }},''')
     error = '\n'.join(error)
     lines = ','.join(map(str, env['@@lines']))
@@ -1007,6 +1244,7 @@ def puppyVMCode(env, main, diffcode, lives):
     if diffcode != '':
         diffcode = f'  diff: function(puppy){{\n{diffcode}\n  }},'
     codehash = hashlib.sha256(world.encode() + main.encode()).hexdigest()
+    # クライアントは main から動かし直すので, diff があっても main は送る
     return f'''
 return {{
   hash: '{codehash}',
@@ -1029,19 +1267,47 @@ return {{
 '''
 
 
-def makeCode(s, errors=[]):
-    global prev_code, prev_lives
-    env, code = transpile(s, errors)
+def compactVMCode(env, main, diffcode, lives):
+    W = env['@@world']
+    world = ','.join(f"'{k}':{W[k]}" for k in W)
+    error = ','.join(
+        f"{{type:'{e['type']}',row:{e['row']},col:{e['col']},len:{e['len']},text:{repr(e['text'])}}}"
+        for e in map(diagnostic, env['@@logs']))
+    lines = ','.join(map(str, env['@@lines']))
+    lives = ''.join(x.strip() for x in lives)
+    if diffcode != '':
+        diffcode = f'diff:function(puppy){{{diffcode}}},'
+    codehash = hashlib.sha256(world.encode() + main.encode()).hexdigest()
+    return (f"return{{hash:'{codehash}',world:{{{world}}},bodies:[],lives:[{lives}],{diffcode}"
+            f"main:async function*(puppy){{{main}}},lines:[{lines}],errors:[{error}]}}")
+
+
+def knowledgeVersion():
+    # 表現を解釈する辞書とモデル (nlpd につながればデーモンのもの)
+    return nlpd.version() or nlp.KNOWLEDGE.version
+
+
+def sourceHash(s, compact=False, knowledge=None):
+    # 同じソースとコンパイラ, 同じ辞書とモデルなら同じ出力になる
+    mode = 'compact' if compact else 'pretty'
+    knowledge = knowledgeVersion() if knowledge is None else knowledge
+    return hashlib.sha256(f'{VERSION}:{GRAMMAR_HASH}:{mode}:{knowledge}\n{s}'.encode()).hexdigest()
+
+
+def makeCode(s, errors=None, live=None, incremental=False, compact=False, phases=None):
+    if live is not None:
+        compact = False  # diffCode は改行とタブで前回と比べる
+    env, code = transpile(s, errors, incremental, compact, phases)
     diffcode, lives = '', []
-    ''' disable live 
-    if not hasErrors(env):
-        diffcode = diffCode(prev_code, code)
-        lives = diffLives(prev_lives, env['@@lives'])
-        prev_code = code
-        prev_lives = env['@@lives']
-    '''
+    if live is not None and not hasErrors(env):
+        diffcode = diffCode(live.code, code)
+        lives = diffLives(live.lives, env['@@lives'])
+        live.code = code
+        live.lives = env['@@lives']
+    start = time.perf_counter()
     code = puppyVMCode(env, code, diffcode, lives)
-    print(code)
+    env['@@phases']['vmcode'] += time.perf_counter() - start
+    log.debug('%s', code)
     return code
 
 # test
@@ -1051,11 +1317,26 @@ def makeCode(s, errors=[]):
 
 
 if __name__ == "__main__":
+    import argparse
+    cmd = argparse.ArgumentParser(description='puppy transpiler')
+    cmd.add_argument('file', nargs='?')
+    cmd.add_argument('--profile', action='store_true', help='report time and JS bytes for each node tag')
+    cmd.add_argument('--collapsed', default='puppy.folded', help='collapsed stacks for flamegraph.pl')
+    args = cmd.parse_args()
     source = '''ガム(500,500,ぴょん,色は緑)\n'''
-    if len(sys.argv) > 1:
-        with open(sys.argv[1]) as f:
+    if args.file is not None:
+        with open(args.file) as f:
             source = f.read()
-    code = makeCode(source)
+    if args.profile:
+        import puppyprof
+        profiler = puppyprof.install(sys.modules[__name__])
+        code = makeCode(source)
+        print(profiler.table(), file=sys.stderr)
+        with open(args.collapsed, 'w') as f:
+            f.write(profiler.collapsed())
+    else:
+        code = makeCode(source)
+    print(code)
 
 
 __package__ = 'puppy'
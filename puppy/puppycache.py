@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import threading
+import weakref
+from pathlib import Path
+from collections import OrderedDict
+
+
+# fork したときに他のスレッドが取っていたロックは子では外れないので, 作り直す
+CACHES = weakref.WeakSet()
+
+
+def restart_in_child():
+    for cache in CACHES:
+        cache.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=restart_in_child)
+
+
+class LRUCache(object):
+    __slots__ = ['capacity', 'sizeof', 'size', 'entries', 'lock', 'hits', 'misses', 'evictions', '__weakref__']
+
+    def __init__(self, capacity, sizeof=sys.getsizeof):
+        self.capacity = capacity  # sizeof で測った合計の上限
+        self.sizeof = sizeof
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        CACHES.add(self)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.capacity:  # 大きすぎるものは入れない
+            return value
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.capacity:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': self.hits / total if total > 0 else 0.0,
+            }
+
+
+class TTLCache(object):
+    __slots__ = ['ttl', 'capacity', 'entries', 'lock', '__weakref__']
+
+    def __init__(self, ttl, capacity=10000):
+        self.ttl = ttl  # 最後に使ってから ttl 秒で消える
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        CACHES.add(self)
+
+    def get(self, key, factory=None):
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            if key in self.entries:
+                value = self.entries.pop(key)[0]
+            elif factory is not None:
+                value = factory()
+            else:
+                return None
+            self.entries[key] = (value, now + self.ttl)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return value
+
+    def expire(self, now):
+        # 使った順に並んでいるので、先頭から期限切れを捨てる
+        while len(self.entries) > 0:
+            key, (_, deadline) = next(iter(self.entries.items()))
+            if deadline > now:
+                break
+            del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+def atomicWrite(path, write, stale=None):
+    # 一時ファイルに write(f) で書いてから置き換える. 他のプロセスが読みかけでも壊れない
+    # stale (glob) に当たる同じディレクトリの古いものは先に消す
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True)
+    if stale is not None:
+        for old in path.parent.glob(stale):
+            if old != path:
+                old.unlink(missing_ok=True)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)  # 書きかけを残さない
+        raise
+    return path
+
+
+__package__ = 'puppycache'
@@ -0,0 +1,60 @@
+import sys
+import pickle
+import hashlib
+from pathlib import Path
+from pegpy.tpeg import grammar
+from puppylog import getLogger
+from puppycache import atomicWrite
+
+log = getLogger('grammar')
+
+# 保存形式を変えたら上げる
+FORMAT = 1
+
+
+def grammarHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def artifactPath(path, digest):
+    path = Path(path)
+    return path.parent / '__pycache__' / f'{path.stem}.{digest[:16]}.tpeg.pickle'
+
+
+def loadGrammar(path='puppy2.tpeg'):
+    # 文法ファイルのハッシュが同じなら、前に読み込んだ文法をそのまま使う
+    digest = grammarHash(path)
+    artifact = artifactPath(path, digest)
+    if artifact.exists():
+        try:
+            with open(artifact, 'rb') as f:
+                version, saved, peg = pickle.load(f)
+            if version == FORMAT and saved == digest:
+                return peg, digest
+        except Exception:
+            pass  # 壊れていたら作り直す
+    peg = grammar(str(path))
+    saveGrammar(peg, path, digest)
+    return peg, digest
+
+
+def saveGrammar(peg, path, digest):
+    artifact = artifactPath(path, digest)
+    try:
+        atomicWrite(artifact, lambda f: pickle.dump((FORMAT, digest, peg), f, protocol=pickle.HIGHEST_PROTOCOL),
+                    stale=f'{Path(path).stem}.*.tpeg.pickle')
+    except (OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+        log.warning('grammar not saved %s: %s', artifact, e)
+        return None
+    return artifact
+
+
+# python puppygrammar.py puppy2.tpeg で前もって作っておける
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'puppy2.tpeg'
+    digest = grammarHash(path)
+    artifact = saveGrammar(grammar(path), path, digest)
+    print(artifact, digest)
+
+__package__ = 'puppygrammar'
@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+import logging
+
+# PUPPY_LOG_LEVEL=DEBUG で開発用の出力, 既定 (WARNING) では出さない
+# PUPPY_LOG_FORMAT=json で一行一レコードの JSON にする
+
+STANDARD = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message'}
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD:  # extra={...} で渡したもの
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup(level=None, format=None):
+    level = level or os.environ.get('PUPPY_LOG_LEVEL', 'WARNING')
+    format = format or os.environ.get('PUPPY_LOG_FORMAT', 'text')
+    handler = logging.StreamHandler(sys.stderr)
+    if format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    root = logging.getLogger('puppy')
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    root.propagate = False
+    return root
+
+
+def getLogger(name):
+    return logging.getLogger(f'puppy.{name}')
+
+
+__package__ = 'puppylog'
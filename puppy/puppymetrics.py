@@ -0,0 +1,124 @@
+import threading
+
+# Prometheus のテキスト形式で出せる簡単なカウンタとヒストグラム
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def labelText(names, values, extra=''):
+    pairs = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(object):
+    __slots__ = ['name', 'help', 'labels', 'values', 'lock']
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{labelText(self.labels, labels)} {value}')
+        return lines
+
+
+class Histogram(object):
+    __slots__ = ['name', 'help', 'labels', 'buckets', 'values', 'lock']
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self.values = {}  # labels => [各バケツの数..., 合計, 回数]
+        self.lock = threading.Lock()
+
+    def observe(self, v, *labels):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            counts = self.values[labels]
+            for i, bound in enumerate(self.buckets):
+                if v <= bound:
+                    counts[i] += 1
+            counts[-2] += v
+            counts[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                for bound, n in zip(self.buckets + ('+Inf',), counts[:-2] + counts[-1:]):
+                    le = labelText(self.labels, labels, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{le} {n}')
+                lines.append(f'{self.name}_sum{labelText(self.labels, labels)} {counts[-2]}')
+                lines.append(f'{self.name}_count{labelText(self.labels, labels)} {counts[-1]}')
+        return lines
+
+
+class Gauge(object):
+    __slots__ = ['name', 'help', 'func']
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func  # 出力するときに値を求める
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.func()}']
+
+
+class CounterFunc(object):
+    __slots__ = ['name', 'help', 'func']
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func  # 増えるだけの値 (キャッシュのヒット数など) を出力するときに求める
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter', f'{self.name} {self.func()}']
+
+
+class Registry(object):
+    __slots__ = ['metrics']
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        self.metrics.append(Counter(name, help, labels))
+        return self.metrics[-1]
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        self.metrics.append(Histogram(name, help, labels, buckets))
+        return self.metrics[-1]
+
+    def gauge(self, name, help, func):
+        self.metrics.append(Gauge(name, help, func))
+        return self.metrics[-1]
+
+    def counterFunc(self, name, help, func):
+        self.metrics.append(CounterFunc(name, help, func))
+        return self.metrics[-1]
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+__package__ = 'puppymetrics'
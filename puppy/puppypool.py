@@ -0,0 +1,117 @@
+import os
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+
+
+class PoolError(Exception):
+    pass
+
+
+def work(conn):
+    # 文法, パーザ, KnowledgeBase はプロセスごとに一度だけ読み込む (fork なら親のもの)
+    from puppy import makeCode, newPhases
+    import nobuai as nlp
+    nlp.unwatch()  # 辞書の読み込み直しは親が reload で指示する
+    while True:
+        try:
+            command, args = conn.recv()
+        except EOFError:
+            break
+        if command == 'reload':
+            conn.send((True, nlp.start_reload()))
+            continue
+        source, live, incremental, compact = args
+        try:
+            errors, phases = [], newPhases()
+            code = makeCode(source, errors, live, incremental, compact, phases)
+            conn.send((True, (code, errors, live, phases)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+
+class Worker(object):
+    __slots__ = ['process', 'conn']
+
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=work, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class CompilePool(object):
+    __slots__ = ['ctx', 'timeout', 'size', 'idle', 'reloading']
+
+    def __init__(self, size=os.cpu_count(), timeout=10.0):
+        method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+        self.ctx = mp.get_context(method)
+        self.timeout = timeout  # 一つのコンパイルにかけてよい秒数
+        self.size = size
+        self.idle = queue.Queue()
+        self.reloading = threading.Lock()  # 二つで取り出し合うと止まる
+        for _ in range(size):
+            self.idle.put(Worker(self.ctx))
+
+    def reload(self):
+        # 全部のワーカに辞書を読み込み直させる (読み込みはワーカの中で別スレッド)
+        # 同じワーカに二度送らないように, 一度全部取り出す
+        with self.reloading:
+            workers = [self.idle.get() for _ in range(self.size)]
+        try:
+            for i in range(len(workers)):
+                for _ in range(2):  # 答えなければ作り直して, もう一度だけ送る
+                    try:
+                        self.send(workers[i], ('reload', ()))
+                        break
+                    except PoolError:
+                        workers[i] = Worker(self.ctx)
+        finally:
+            for worker in workers:
+                self.idle.put(worker)
+
+    def send(self, worker, message):
+        # 答えが来なければ worker を止めて PoolError
+        try:
+            worker.conn.send(message)
+            if not worker.conn.poll(self.timeout):
+                raise PoolError(f'{message[0]} timeout ({self.timeout}s)')
+            return worker.conn.recv()
+        except (PoolError, EOFError, OSError) as e:
+            worker.stop()
+            raise PoolError(str(e) or 'compile worker crashed')
+
+    def makeCode(self, s, errors=None, live=None, incremental=False, compact=False, phases=None):
+        worker = self.idle.get()
+        try:
+            ok, result = self.send(worker, ('compile', (s, live, incremental, compact)))
+        except PoolError:
+            worker = Worker(self.ctx)  # 固まったか落ちたワーカは作り直す
+            raise
+        finally:
+            self.idle.put(worker)
+        if not ok:
+            raise PoolError(result)
+        code, logs, newlive, times = result
+        if errors is not None:
+            errors.extend(logs)
+        if phases is not None:
+            for key, value in times.items():
+                if isinstance(value, str):  # knowledge
+                    if value != '':
+                        phases[key] = value if phases.get(key, '') in ('', value) else 'mixed'
+                else:
+                    phases[key] = phases.get(key, 0) + value
+        if live is not None:
+            live.code = newlive.code
+            live.lives = newlive.lives
+        return code
+
+
+__package__ = 'puppypool'
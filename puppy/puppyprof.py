@@ -0,0 +1,64 @@
+import time
+
+# python puppy.py --profile sample.py
+# conv の呼び出しをノードの種類 (tag) ごとに計る
+# 自分の時間 (self) は子ノードの conv にかかった時間を除いたもの
+
+
+class Profiler(object):
+    __slots__ = ['conv', 'stats', 'stack', 'stacks']
+
+    def __init__(self, conv):
+        self.conv = conv
+        self.stats = {}   # tag => [回数, 合計時間, 自分の時間, 合計バイト, 自分のバイト]
+        self.stack = []   # [tag, 子の時間, 子のバイト, out]
+        self.stacks = {}  # 'Source;ApplyExpr;...' => 自分の時間
+
+    def __call__(self, env, t, out):
+        tag = t.tag
+        start = len(out)
+        frame = [tag, 0.0, 0, out]
+        recursive = any(f[0] == tag for f in self.stack)
+        self.stack.append(frame)
+        t0 = time.perf_counter()
+        try:
+            return self.conv(env, t, out)
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.stack.pop()
+            size = sum(len(x.encode('utf-8')) for x in out[start:])  # JS のバイト数
+            stat = self.stats.setdefault(tag, [0, 0.0, 0.0, 0, 0])
+            stat[0] += 1
+            if not recursive:  # 再帰したときは一番外側だけ合計に入れる
+                stat[1] += elapsed
+                stat[3] += size
+            stat[2] += elapsed - frame[1]
+            stat[4] += size - frame[2]
+            if len(self.stack) > 0:
+                parent = self.stack[-1]
+                parent[1] += elapsed
+                if parent[3] is out:  # 別のリストに出力したものは親のバイト数に入らない
+                    parent[2] += size
+            key = ';'.join([f[0] for f in self.stack] + [tag])
+            self.stacks[key] = self.stacks.get(key, 0.0) + elapsed - frame[1]
+
+    def table(self):
+        lines = [f"{'tag':24} {'calls':>8} {'total ms':>10} {'self ms':>10} {'total B':>10} {'self B':>10}"]
+        rows = sorted(self.stats.items(), key=lambda x: x[1][2], reverse=True)
+        for tag, (calls, total, own, size, ownsize) in rows:
+            lines.append(f'{tag:24} {calls:8} {total*1000:10.3f} {own*1000:10.3f} {size:10} {ownsize:10}')
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        # flamegraph.pl にそのまま渡せる形式 (重みはマイクロ秒)
+        return ''.join(f'{key} {int(t * 1e6)}\n' for key, t in sorted(self.stacks.items()))
+
+
+def install(module):
+    # module は puppy (python puppy.py で動かしたときは __main__)
+    profiler = Profiler(module.conv)
+    module.conv = profiler
+    return profiler
+
+
+__package__ = 'puppyprof'
@@ -1,89 +1,136 @@
 __package__ = 'puppytypes'
 
-VARID = 0
-VARS = {}
+import re
+from contextvars import ContextVar
+from contextlib import contextmanager
+from puppylog import getLogger
 
-
-def initTypeVars():
-    global VARS
-    VARS = {}
+log = getLogger('types')
 
 
 def newTypeVar():
-    global VARID
-    VARID += 1
-    return f'_{VARID}'
+    return solver().newVar()
+
+
+class TypeSolver(object):
+    __slots__ = ['varid', 'parent', 'bound']
+
+    def __init__(self):
+        self.varid = 0    # 型変数の名前はコンパイルごとに _1 から
+        self.parent = {}  # 型変数 => 同じクラスの型変数 (union-find)
+        self.bound = {}   # 代表の型変数 => 型
+
+    def newVar(self):
+        self.varid += 1
+        return f'_{self.varid}'
+
+    def find(self, v):
+        parent = self.parent
+        root = v
+        while root in parent:
+            root = parent[root]
+        while v != root:  # 経路圧縮
+            parent[v], v = root, parent[v]
+        return root
+
+    def resolve(self, name):
+        if name.startswith('_'):
+            root = self.find(name)
+            if root in self.bound:
+                return self.resolve(self.bound[root])
+            return root
+        if name.startswith('list['):
+            return f'list[{self.resolve(name[5:-1])}]'
+        return name
+
+    def unify(self, pat, vat):
+        pat, vat = self.resolve(pat), self.resolve(vat)
+        if pat == vat:
+            return True
+        if pat.startswith('_'):
+            return self.bind(pat, vat)
+        if vat.startswith('_'):
+            return self.bind(vat, pat)
+        if pat.startswith('list[') and vat.startswith('list['):
+            return self.unify(pat[5:-1], vat[5:-1])
+        return False
+
+    def bind(self, v, t):
+        if t.startswith('_'):  # 両方とも型変数
+            self.parent[v] = t
+            return True
+        if v in re.findall(r'_\d+', t):  # list[_1] = _1 は作らない
+            return False
+        self.bound[v] = t
+        return True
 
 
-def unique(t, a=newTypeVar(), b=newTypeVar()):
+# 型変数の束縛はコンパイルごとに別
+SOLVER = ContextVar('SOLVER', default=TypeSolver())
+
+
+def solver():
+    return SOLVER.get()
+
+
+@contextmanager
+def typeScope():
+    token = SOLVER.set(TypeSolver())
+    try:
+        yield SOLVER.get()
+    finally:
+        SOLVER.reset(token)
+
+
+def unique(t, a=None, b=None):
+    if a is None:  # 呼び出しごとに新しい型変数にする
+        a, b = newTypeVar(), newTypeVar()
     if isinstance(t, tuple):
         return tuple([unique(x, a, b) for x in t])
     elif isinstance(t, dict) or isinstance(t, str):
         return t
     else:
         if '$a' in t.name or '$b' in t.name:
-            return Type(t.name.replace('$a', a).replace('$b', a))
+            return Type(t.name.replace('$a', a).replace('$b', b))
         return t
 
 
-def setVarType(v, t):
-    if t.startswith('_'):  # 両方とも型変数
-        ts = {v, t}
-        if v in VARS:
-            ts |= VARS[v]
-        if t in VARS:
-            ts |= VARS[t]
-        ts = tuple(ts)
-        for x in ts:
-            VARS[x] = ts
-        return
-    if v in VARS:
-        for x in VARS[v]:
-            VARS[x] = t
-    else:
-        VARS[v] = t
-
-
-def matchVarType(pat, vat):
-    if pat.startswith('_'):
-        setVarType(pat, vat)
-        return (pat, vat) if vat.startswith('_') else (pat, pat)
-    if vat.startswith('_'):
-        setVarType(vat, pat)
-        return (pat, pat)
-    if pat.startswith('list[') and vat.startswith('list['):
-        res = matchVarType(pat[5:-1], vat[5:-1])
-        if res is not None:
-            return (f'list[{res[0]}]', f'list[{res[1]}]')
-    return None
-
-
 def strType(pat):
     if isinstance(pat, tuple) or isinstance(pat, list):
         return '(' + ','.join(map(strType, pat[1:])) + ')=>'+strType(pat[0])
     if isinstance(pat, Type):
         pat = pat.name
     if isinstance(pat, str):
-        if pat.startswith('list['):
-            return f'list[{strType(pat[5:-1])}]'
-        if pat in VARS:
-            ts = VARS[pat]
-            if isinstance(ts, str):
-                return ts
-        return pat
+        return solver().resolve(pat)
     if isinstance(pat, dict):
         return '**options'
-    print('@FIXME', pat)
+    log.warning('strType: unknown type %r', pat)
     return str(pat)
 
 
-class Type:
+# 型変数を含まない型は一つだけ作る
+INTERNED = {}
+
+
+class Type(object):
     __slots__ = ['name']
 
-    def __init__(self, name='__'):
-        self.name = name
+    def __new__(cls, name='__'):
         if '__' in name:
-            self.name = name.replace('__', newTypeVar())
+            name = name.replace('__', newTypeVar())
+        elif name in INTERNED:
+            return INTERNED[name]
+        self = object.__new__(cls)
+        object.__setattr__(self, 'name', name)
+        if '_' not in name:
+            INTERNED[name] = self
+        return self
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Type is immutable')
+
+    def __reduce__(self):
+        return (Type, (self.name,))
 
     def __str__(self):
         return strType(self.name)
@@ -95,21 +142,19 @@ class Type:
         return self.__str__() == str(a)
 
     def isVarType(self):
-        return '_' in self.name
+        return '_' in self.__str__()
 
     def match(self, given):
         pats, vat = str(self), str(given)
         if pats.endswith('?'):
             pats = pats[:-1]
-        for pat in pats.split('|'):
-            if pat == vat:
+        alts = pats.split('|')
+        if vat in alts:
+            return True
+        for pat in alts:
+            if solver().unify(pat, vat):
                 return True
-        res = matchVarType(pat, vat)
-        if res is None:
-            return False
-        self.name = res[0]
-        given.name = res[1]
-        return True
+        return False
 
 
 def newType(v='__'):
@@ -122,10 +167,9 @@ def newType(v='__'):
 
 def matchType(t, t2):
     if isinstance(t, str):
-        print('matchType', t, t2, type(t2))
-        if t == 'any' or t2.isVarType():
+        if t == 'any' or (isinstance(t2, Type) and t2.isVarType()):
             return True
-        u2 = str(t2)
+        u2 = strType(t2)
         for u in t.split('|'):
             if u2.startswith(u):
                 return True
@@ -197,10 +241,10 @@ def isMatterFunc(types):
 def typeOfSeq(ty):
     if isinstance(ty, Type) and ty == String:
         return String
-    name = '__'
-    if isinstance(ty, Type) and ty.name.startswith('list['):
-        name = ty.name[5:-1]
-    return Type(name)
+    name = str(ty) if isinstance(ty, Type) else '__'
+    if name.startswith('list['):
+        return Type(name[5:-1])
+    return Type()
 
 
 def unaryPrefix(op):
@@ -1,12 +1,28 @@
 
 
 import os
+import sys
+import gzip
+import time
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from subprocess import STDOUT, check_output
 from pathlib import Path
-from flask import Flask, render_template, send_file, request, Response, jsonify
-from puppy import makeCode
+from flask import Flask, render_template, send_file, request, Response, jsonify, g
+from puppy import makeCode, sourceHash, knowledgeVersion, diagnostic, Live, newPhases
+from puppycache import LRUCache, TTLCache
+from puppypool import CompilePool, PoolError
+from puppymetrics import Registry
+import puppylog
+import nobuai as nlp
+import nlpd
 from flask_cors import CORS
 import json
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def getRootPath(subdir='data'):
@@ -21,10 +37,112 @@ def uid():
     return 'kkuramitsu'
 
 
+log = puppylog.setup()
+
+
+# 同じソースのコンパイル結果 (code, errors) を使い回す (PUPPY_CACHE_SIZE バイトまで)
+CODE_CACHE = LRUCache(int(os.environ.get('PUPPY_CACHE_SIZE', 64 * 1024 * 1024)),
+                      sizeof=lambda entry: sys.getsizeof(entry[0]) + 256 * len(entry[1]))
+# 圧縮したもの (PUPPY_ENCODED_CACHE_SIZE バイトまで)
+ENCODED_CACHE = LRUCache(int(os.environ.get('PUPPY_ENCODED_CACHE_SIZE', 16 * 1024 * 1024)), sizeof=len)
+# ライブ更新のセッション (PUPPY_SESSION_TTL 秒使わなければ消える)
+LIVE_SESSIONS = TTLCache(int(os.environ.get('PUPPY_SESSION_TTL', 30 * 60)))
+# PUPPY_WORKERS を指定すると、コンパイルは別プロセスで並列に行う
+WORKERS = int(os.environ.get('PUPPY_WORKERS', 0))
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+def compile_pool():
+    # プールは最初に使うときに作る (Werkzeug の reloader の親プロセスでは作らない)
+    # word2vec を読み込んでいる間は fork しないで, このプロセスでコンパイルする
+    global POOL
+    if POOL is None and WORKERS > 0 and nlp.STATUS['state'] != 'loading':
+        with POOL_LOCK:
+            if POOL is None:
+                POOL = CompilePool(WORKERS, float(os.environ.get('PUPPY_COMPILE_TIMEOUT', 10)))
+    return POOL
+
+
+def compile_source(s, errors=None, live=None, incremental=False, compact=False, phases=None):
+    pool = compile_pool()
+    if pool is None:
+        return makeCode(s, errors, live, incremental, compact, phases)
+    return pool.makeCode(s, errors, live, incremental, compact, phases)
+
+# /metrics (Prometheus のテキスト形式)
+METRICS = Registry()
+REQUESTS = METRICS.counter('puppy_http_requests_total', 'HTTP requests', ['endpoint', 'status'])
+LATENCY = METRICS.histogram('puppy_http_request_seconds', 'HTTP request latency', ['endpoint'])
+PHASES = METRICS.histogram('puppy_compile_phase_seconds', 'Time spent in each compiler phase', ['phase'])
+NLP_CALLS = METRICS.counter('puppy_nlp_conv2_calls_total', 'Phrases resolved by nlp.conv2')
+SIMILARITY_CALLS = METRICS.counter('puppy_word2vec_similarity_total', 'word2vec similarity computations')
+METRICS.counterFunc('puppy_code_cache_hits_total', 'Compile cache hits', lambda: CODE_CACHE.stats()['hits'])
+METRICS.counterFunc('puppy_code_cache_misses_total', 'Compile cache misses', lambda: CODE_CACHE.stats()['misses'])
+METRICS.gauge('puppy_code_cache_bytes', 'Compile cache size', lambda: CODE_CACHE.stats()['size'])
+METRICS.counterFunc('puppy_phrase_cache_hits_total', 'NLP phrase cache hits',
+                    lambda: nlp.PHRASE_CACHE.stats()['hits'])
+METRICS.counterFunc('puppy_phrase_cache_misses_total', 'NLP phrase cache misses',
+                    lambda: nlp.PHRASE_CACHE.stats()['misses'])
+METRICS.gauge('puppy_phrase_cache_entries', 'NLP phrase cache entries', lambda: len(nlp.PHRASE_CACHE))
+METRICS.gauge('puppy_nlp_ready', 'word2vec model is loaded', lambda: int(nlp.STATUS['state'] == 'ready'))
+METRICS.gauge('puppy_live_sessions', 'Live update sessions', lambda: len(LIVE_SESSIONS))
+MEASURED = ('/api/compile', '/api/compile/batch', '/build/<path:d>')
+
+
+def observe_phases(phases):
+    for phase in ('parse', 'conv', 'typecheck', 'nlp', 'vmcode'):
+        PHASES.observe(phases[phase], phase)
+    NLP_CALLS.inc(phases['nlpCalls'])
+    SIMILARITY_CALLS.inc(phases['similarityCalls'])
+
+
+# PUPPY_NLP_WATCH 秒ごとに辞書ファイルを調べて、書き換えられたら読み込み直す (0 なら調べない)
+NLP_WATCH = float(os.environ.get('PUPPY_NLP_WATCH', 5))
+ADMIN_TOKEN = os.environ.get('PUPPY_ADMIN_TOKEN')
+
 app = Flask(__name__, template_folder='client/build', static_folder='client/build/static')
 CORS(app)
 
 
+WATCHING = threading.Event()
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    # 辞書はリクエストを受けるプロセスだけで調べる (reloader の親プロセスでは動かさない)
+    if NLP_WATCH > 0 and not WATCHING.is_set():
+        with POOL_LOCK:
+            if not WATCHING.is_set():
+                WATCHING.set()
+                nlp.watch(NLP_WATCH, lambda: reload_all(remote=False))  # nlpd は自分で調べる
+
+
+def reload_all(remote=True):
+    # このプロセスとコンパイルのワーカ (と nlpd) の辞書を読み込み直す
+    started = nlp.start_reload()
+    if POOL is not None:  # 全部のワーカが空くまで待つので別スレッドで
+        threading.Thread(target=POOL.reload, name='pool-reload', daemon=True).start()
+    if remote and nlpd.SOCKET is not None:
+        nlpd.reload()
+    return started
+
+
+@app.after_request
+def record_request(res):
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    if rule in MEASURED:
+        LATENCY.observe(time.perf_counter() - g.start, rule)
+        REQUESTS.inc(1, rule, str(res.status_code))
+    return res
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/<path:d>')
 def dist(d):
     return send_file(f'client/build/{d}')
@@ -111,10 +229,178 @@ def dist_build(d):
     return send_file("output.txt")
 
 
+def compile_cached(source, key=None, compact=False, knowledge=None):
+    # (code, errors, キャッシュしたか)
+    # knowledge はキーに入れた辞書とモデル (ワーカや nlpd が違うもので解釈したらキャッシュしない)
+    knowledge = knowledgeVersion() if knowledge is None else knowledge
+    key = key or sourceHash(source, compact, knowledge)
+    entry = CODE_CACHE.get(key)
+    if entry is not None:
+        return entry + (True,)
+    errors, phases = [], newPhases()
+    code = compile_source(source, errors, compact=compact, phases=phases)
+    observe_phases(phases)
+    if phases['nlpPending']:  # 辞書だけで解釈したもの (読み込みが終われば変わる)
+        return code, errors, False
+    if phases['knowledge'] not in ('', knowledge):  # 読み込み直す前か後の辞書で解釈した
+        return code, errors, False
+    CODE_CACHE.put(key, (code, errors))
+    return code, errors, True
+
+
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def encode(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data)
+    return gzip.compress(data, mtime=0)
+
+
+def accepted_encoding():
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def entity_tag(key, encoding):
+    # 圧縮したものとしないものは違うバイト列なので, ETag も分ける
+    return f'{key}-{encoding or "identity"}'
+
+
+def send_code(code, key=None):
+    encoding = accepted_encoding()
+    body = code
+    if encoding is not None:
+        body = ENCODED_CACHE.get(f'{key}:{encoding}') if key else None
+        if body is None:
+            body = encode(code.encode('utf-8'), encoding)
+            if key:
+                ENCODED_CACHE.put(f'{key}:{encoding}', body)
+    res = Response(body, mimetype='application/javascript')
+    res.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        res.headers['Content-Encoding'] = encoding
+    if key:
+        res.set_etag(entity_tag(key, encoding))
+    return res
+
+
+def compact_requested():
+    # ?compact=1 なら空白やコメントを省いた短いコードを返す
+    return request.args.get('compact', request.headers.get('X-Puppy-Compact', '')) not in ('', '0', 'false')
+
+
 @app.route('/api/compile', methods=['POST'])
 def transcompile():
-    inputText = request.data
-    return Response(makeCode(inputText.decode('utf-8'), []), mimetype='application/javascript')
+    source = request.data.decode('utf-8')
+    session = request.headers.get('X-Puppy-Session', request.args.get('session'))
+    compact = compact_requested()
+    try:
+        # 前回との差分 (diff, lives) も送る. diffCode は行単位なので compact にはしない
+        if session:
+            live = LIVE_SESSIONS.get(session, Live)
+            phases = newPhases()
+            with live.lock:  # 前回のコードとの差分なので, 同じセッションは順番に
+                code = compile_source(source, [], live, incremental=True, phases=phases)
+            observe_phases(phases)
+            return send_code(code)
+        knowledge = knowledgeVersion()
+        key = sourceHash(source, compact, knowledge)
+        tag = entity_tag(key, accepted_encoding())
+        if request.if_none_match.contains(tag):  # ブラウザが同じものを持っている
+            res = Response(status=304)
+            res.headers['Vary'] = 'Accept-Encoding'
+            res.set_etag(tag)
+            return res
+        code, errors, cached = compile_cached(source, key, compact, knowledge)
+        log.info('compile', extra={'hash': key, 'lines': source.count('\n') + 1,
+                                   'bytes': len(code), 'errors': len(errors)})
+    except PoolError as e:
+        log.error('compile failed: %s', e)
+        return Response(str(e), status=503, mimetype='text/plain')
+    return send_code(code, key if cached else None)
+
+
+def compile_item(item, compact=False):
+    try:
+        code, errors, _ = compile_cached(item['source'], compact=compact)
+    except PoolError as e:
+        log.error('compile failed: %s %s', item.get('id'), e)
+        return {'id': item.get('id'), 'error': str(e)}
+    except Exception as e:  # 一つ失敗しても他の結果は返す
+        log.exception('compile failed: %s', item.get('id'))
+        return {'id': item.get('id'), 'error': f'{type(e).__name__}: {e}'}
+    return {'id': item.get('id'), 'code': code, 'errors': list(map(diagnostic, errors))}
+
+
+@app.route('/api/compile/batch', methods=['POST'])
+def transcompile_batch():
+    # [{id, source}, ...] をまとめてコンパイルする
+    items = request.get_json(force=True, silent=True)
+    if not isinstance(items, list) or not all(isinstance(x, dict) and isinstance(x.get('source'), str) for x in items):
+        return jsonify({'error': 'expected [{"id": ..., "source": ...}, ...]'}), 400
+    stream = request.args.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', '')
+    executor = ThreadPoolExecutor(max(WORKERS, 1))
+    compact = compact_requested()
+    futures = [executor.submit(compile_item, item, compact) for item in items]
+    executor.shutdown(wait=False)
+    if stream:  # 終わったものから NDJSON で返す
+        def generate():
+            for future in as_completed(futures):
+                yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+    return jsonify([future.result() for future in futures])
+
+
+@app.route('/api/nlp/status')
+def nlp_status():
+    # 読み込み中は辞書だけで解釈している (503)
+    # lazy (nlpd を使うとき) で読み込んでいなければ, 使えるので 200
+    status = nlp.status()
+    if nlpd.SOCKET is not None:
+        status['remote'] = dict(nlpd.REMOTE, socket=nlpd.SOCKET)
+    return jsonify(status), 200 if not nlp.pending() else 503
+
+
+RESOLVE_MAX = int(os.environ.get('PUPPY_NLP_RESOLVE_MAX', 1000))
+
+
+@app.route('/api/nlp/resolve', methods=['POST'])
+def nlp_resolve():
+    # {"phrases": ["ふわふわ", ...], "property": "color", "k": 5}
+    # => 解釈した結果 (option, messages) と似ている辞書の単語 (suggestions)
+    query = request.get_json(force=True, silent=True)
+    if not isinstance(query, dict):
+        return jsonify({'error': 'expected {"phrases": [...], "property": ..., "k": ...}'}), 400
+    phrases, property, k = query.get('phrases'), query.get('property'), query.get('k', 5)
+    if not isinstance(phrases, list) or not all(isinstance(x, str) for x in phrases):
+        return jsonify({'error': 'phrases must be a list of strings'}), 400
+    if len(phrases) > RESOLVE_MAX:
+        return jsonify({'error': f'too many phrases (max {RESOLVE_MAX})'}), 400
+    if property is not None and not isinstance(property, str):
+        return jsonify({'error': 'property must be a string'}), 400
+    if not isinstance(k, int) or not 0 <= k <= 100:
+        return jsonify({'error': 'k must be an integer from 0 to 100'}), 400
+    results = nlpd.suggest(phrases, property, k)  # PUPPY_NLP_SOCKET があれば nlpd に頼む
+    if results is not None:
+        return jsonify({'pending': nlpd.REMOTE['pending'], 'results': results})
+    return jsonify({'pending': nlp.pending(), 'results': nlp.resolve(phrases, property, k)})
+
+
+@app.route('/api/nlp/reload', methods=['POST'])
+def nlp_reload():
+    # PUPPY_ADMIN_TOKEN を設定したときだけ使える (X-Puppy-Admin-Token が同じとき)
+    if ADMIN_TOKEN is None:
+        return jsonify({'error': 'disabled (set PUPPY_ADMIN_TOKEN)'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Puppy-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'forbidden'}), 403
+    # 読み込み直している間も、コンパイルは前の辞書で続ける
+    started = reload_all()
+    return jsonify(dict(nlp.status(), started=started)), 202
+
+
+@app.route('/api/compile/stats')
+def compile_stats():
+    return jsonify(CODE_CACHE.stats())
 
 
 '''
@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# puppy のモジュールは puppy/ で動かす前提 (nlp_dict/... などの相対パス)
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+os.environ.setdefault('PUPPY_NLP_LOAD', 'lazy')  # テストでは word2vec を読み込まない
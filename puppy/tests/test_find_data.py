@@ -0,0 +1,58 @@
+import random
+import nobuai as nlp
+
+
+# トライにする前の find_data (辞書だけのとき). 結果が同じか比べる
+def old_find_data(phrase, base):
+    prefix = ''
+    w = phrase
+    while len(w) > 0:
+        if w in base:
+            data = dict(base[w])
+            found = old_find_data(nlp.suffix(prefix), base)
+            data.update(found)
+            return data
+        prefix += w[0]
+        w = w[1:]
+    return {}
+
+
+def old_conv_phrase(phrase, base):
+    d = {}
+    if 'は' in phrase:
+        pos = phrase.find('は')
+        key = old_find_data(phrase[0:pos], base).get('property', phrase[0:pos])
+        value = old_find_data(phrase[pos+1:], base).get(key)
+        if value is not None:
+            d[key] = value
+            return d
+    d.update(old_find_data(phrase, base))
+    return d
+
+
+def random_phrases(base, n, seed=0):
+    rng = random.Random(seed)
+    words = sorted(base)
+    chars = sorted(set(''.join(words[:2000]))) + ['の', 'は']
+    for _ in range(n):
+        parts = []
+        for _ in range(rng.randint(1, 4)):
+            if rng.random() < 0.6:
+                parts.append(rng.choice(words))
+            else:
+                parts.append(''.join(rng.choice(chars) for _ in range(rng.randint(1, 3))))
+            if rng.random() < 0.3:
+                parts.append(rng.choice(['の', 'は', '']))
+        yield ''.join(parts)
+
+
+def test_same_as_old_find_data(monkeypatch):
+    # word2vec なしで, 乱数で作った 20000 の表現を前の実装と比べる
+    knowledge = nlp.Knowledge(nlp.KNOWLEDGE.base, nlp.KNOWLEDGE.suffixes)
+    monkeypatch.setattr(nlp, 'KNOWLEDGE', knowledge)
+    monkeypatch.setitem(nlp.STATUS, 'state', 'unavailable')
+    nlp.PHRASE_CACHE.clear()
+    base = knowledge.base
+    for phrase in random_phrases(base, 20000):
+        assert nlp.find_data(phrase, lambda x: None) == old_find_data(phrase, base), phrase
+        assert nlp.conv2(phrase) == old_conv_phrase(phrase, base), phrase
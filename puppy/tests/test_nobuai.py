@@ -0,0 +1,76 @@
+import pytest
+import nobuai as nlp
+
+np = pytest.importorskip('numpy')
+
+
+def fake_model(words, dim=8, seed=0):
+    import wordvec
+    rng = np.random.default_rng(seed)
+    return wordvec.WordVectors(list(words), rng.normal(size=(len(words), dim)).astype(np.float32))
+
+
+@pytest.fixture
+def vectors():
+    # 辞書の単語と辞書にない単語 w0, w1, ... を持つモデルを入れる
+    saved = nlp.KNOWLEDGE
+    model = fake_model(list(saved.base) + [f'w{i}' for i in range(20)])
+    knowledge = nlp.Knowledge(saved.base, saved.suffixes, nlp.init_wordvec(model, saved.base, 'fake.bin'))
+    nlp.install(knowledge)
+    yield model
+    nlp.install(saved)
+
+
+def test_empty_domain(vectors):
+    # モデルにある単語を持たない性質でも落ちない
+    assert nlp.KNOWLEDGE.find_sim('w1', lambda x: None, 'bogus') is None
+    assert nlp.find_topk(['w1'], 3, 'bogus') == [[]]
+    messages = []
+    assert nlp.conv2('大きさはふわふわ', messages.append) == {}  # 候補がないので何も返さない
+    assert messages == []
+
+
+def test_similar_word(vectors):
+    messages = []
+    option = nlp.conv2('w3', messages.append)
+    assert len(option) > 0
+    assert '類似度' in messages[0]
+    assert nlp.conv2('w3', messages.append) == option  # キャッシュからも同じメッセージ
+    assert messages[0] == messages[1]
+
+
+def test_prebuilt_domains(monkeypatch):
+    # 索引を作る大きさなら全部の性質の domain を先に作るが, 空の domain があっても読み込める
+    import annindex
+    monkeypatch.setattr(annindex, 'MIN_SIZE', 1)
+    monkeypatch.setattr(annindex, 'domainIndex', lambda matrix, words, path: None)
+    base = dict(nlp.KNOWLEDGE.base)
+    base['ふわふわ'] = nlp.MappingProxyType({'softness': 1})  # モデルにない単語だけの性質
+    model = fake_model([x for x in base if x != 'ふわふわ'])
+    find_sim, find_topk = nlp.init_wordvec(model, base, 'fake.bin')
+    assert find_topk(['赤'], 1, 'softness') == [[]]
+    assert find_topk(['赤'], 1, 'color')[0][0][0] == '赤'
+
+
+def test_resolve_unknown_property(vectors, monkeypatch):
+    # 辞書にない性質を聞かれても domain を作らず, 候補は空
+    calls = []
+    monkeypatch.setattr(nlp.KNOWLEDGE, 'find_topk', lambda *args: calls.append(args))
+    results = nlp.resolve(['w1', '赤'], 'no-such-property', 3)
+    assert [r['suggestions'] for r in results] == [[], []]
+    assert calls == []
+    monkeypatch.undo()
+    assert 'color' in nlp.KNOWLEDGE.properties()
+    assert len(nlp.resolve(['w1'], 'color', 3)[0]['suggestions']) == 3
+
+
+def test_reload_keeps_version():
+    # 同じ辞書を読み込み直しても version は同じ (キャッシュのキーが変わらない)
+    saved = nlp.KNOWLEDGE
+    try:
+        assert nlp.reload_dictionaries()
+        assert nlp.KNOWLEDGE is not saved
+        assert nlp.KNOWLEDGE.version == saved.version != ''
+        assert nlp.withVectors(saved.version) != saved.version
+    finally:
+        nlp.install(saved)
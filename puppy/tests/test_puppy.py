@@ -0,0 +1,12 @@
+import pytest
+
+pytest.importorskip('pegpy')
+import puppy
+
+
+def test_keyword_nlp_value():
+    # color=赤 のように, キーワード引数の値を辞書で解釈する
+    errors = []
+    code = puppy.makeCode('A = Ball(100, 100, color=赤)\n', errors)
+    assert 'main' in code
+    assert [e for e in errors if e[0] == 'error'] == []
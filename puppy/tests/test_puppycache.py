@@ -0,0 +1,30 @@
+import os
+import signal
+import pytest
+from puppycache import LRUCache, atomicWrite
+
+
+def test_atomic_write(tmp_path):
+    (tmp_path / 'knowledge.old.pickle').write_bytes(b'old')
+    path = atomicWrite(tmp_path / 'knowledge.new.pickle', lambda f: f.write(b'new'), stale='knowledge.*.pickle')
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['knowledge.new.pickle']
+    assert path.read_bytes() == b'new'
+    with pytest.raises(ValueError):  # 失敗したら前のものが残り, 書きかけは消える
+        atomicWrite(path, lambda f: (f.write(b'half'), int('x')))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['knowledge.new.pickle']
+    assert path.read_bytes() == b'new'
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork only')
+def test_lock_after_fork():
+    # 他のスレッドがロックを取っているときに fork しても, 子で使える
+    cache = LRUCache(100)
+    cache.lock.acquire()
+    pid = os.fork()
+    if pid == 0:
+        signal.alarm(5)  # 止まったら失敗にする
+        cache.put('a', 1)
+        os._exit(0 if cache.get('a') == 1 else 1)
+    cache.lock.release()
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
@@ -0,0 +1,76 @@
+import pickle
+import threading
+import puppytypes as ts
+from puppytypes import TypeSolver, Type, typeScope
+
+
+def test_unify_binds_variable():
+    s = TypeSolver()
+    a = s.newVar()
+    assert s.unify(a, 'number')
+    assert s.resolve(a) == 'number'
+    assert s.unify('number', a)
+    assert not s.unify(a, 'str')
+
+
+def test_unify_variables_then_bind():
+    s = TypeSolver()
+    a, b, c = s.newVar(), s.newVar(), s.newVar()
+    assert s.unify(a, b) and s.unify(b, c)
+    assert s.find(a) == s.find(c)
+    assert s.unify(c, 'str')
+    assert s.resolve(a) == 'str'
+
+
+def test_unify_list():
+    s = TypeSolver()
+    a = s.newVar()
+    assert s.unify('list[number]', f'list[{a}]')
+    assert s.resolve(f'list[{a}]') == 'list[number]'
+    assert not s.unify('list[number]', 'list[str]')
+    assert not s.unify('list[number]', 'number')
+
+
+def test_occurs_check():
+    # list[_1] = _1 は作らない
+    s = TypeSolver()
+    a = s.newVar()
+    assert not s.unify(a, f'list[{a}]')
+    assert s.resolve(a) == a
+
+
+def test_type_scope_isolation():
+    with typeScope() as outer:
+        t = Type()
+        assert t.name == '_1'
+        with typeScope() as inner:
+            assert inner is not outer
+            u = Type()
+            assert u.name == '_1'  # コンパイルごとに _1 から
+            assert u.match(ts.Int)
+            assert str(u) == 'number'
+        assert ts.solver() is outer
+        assert str(t) == '_1'  # 中のスコープの束縛は残らない
+
+
+def test_type_scope_threads():
+    # スレッドごとに別の solver を使う
+    names = {}
+
+    def compile(key):
+        with typeScope():
+            names[key] = [Type().name for _ in range(3)]
+
+    threads = [threading.Thread(target=compile, args=(i,)) for i in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert all(v == ['_1', '_2', '_3'] for v in names.values())
+
+
+def test_interned_types():
+    assert Type('number') is ts.Int
+    assert pickle.loads(pickle.dumps(ts.Int)) is ts.Int
+    with typeScope():
+        assert Type() is not Type()
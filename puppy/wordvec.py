@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import hashlib
+from pathlib import Path
+from puppylog import getLogger
+from puppycache import atomicWrite
+
+log = getLogger('wordvec')
+
+# word2vec のモデル (バイナリ) を前もって変換しておく
+#   python wordvec.py convert nlp_dict/word2vec.model.bin
+#   python wordvec.py verify nlp_dict/word2vec.model.bin
+# .vectors.npy (float32) を読み込み専用で mmap するので、起動が速く、
+# サーバとワーカのプロセスで同じページを共有できる
+
+FORMAT = 1
+LIMIT = 500000
+
+
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def storePaths(path):
+    path = Path(path)
+    return (path.with_suffix('.vectors.npy'), path.with_suffix('.vocab.txt'),
+            path.with_suffix('.meta.json'))
+
+
+class WordVectors(object):
+    __slots__ = ['words', 'index', 'vectors']
+
+    def __init__(self, words, vectors):
+        self.words = words
+        self.index = {w: i for i, w in enumerate(words)}
+        self.vectors = vectors
+
+    def __contains__(self, w):
+        return w in self.index
+
+    def __getitem__(self, w):
+        return self.vectors[self.index[w]]
+
+    def __len__(self):
+        return len(self.words)
+
+
+def convert(path, limit=LIMIT):
+    import numpy as np
+    from gensim.models import KeyedVectors
+    model = KeyedVectors.load_word2vec_format(str(path), limit=limit, binary=True)
+    words = list(model.index_to_key)
+    npy, vocab, meta = storePaths(path)
+    atomicWrite(npy, lambda f: np.save(f, np.ascontiguousarray(model.vectors, dtype=np.float32)))
+    atomicWrite(vocab, lambda f: f.write(''.join(w + '\n' for w in words).encode('utf-8')))
+    stat = os.stat(path)
+    info = {
+        'format': FORMAT,
+        'source': Path(path).name,
+        'sha256': fileHash(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'limit': limit,
+        'count': len(words),
+        'dim': int(model.vectors.shape[1]),
+    }
+    # 最後に書くので、途中で止まったものは読まれない
+    atomicWrite(meta, lambda f: f.write(json.dumps(info, indent=2).encode('utf-8')))
+    return info
+
+
+def verify(path, full=True):
+    # 変換したときの元のモデルと同じか (full=False なら大きさと更新時刻だけ見る)
+    npy, vocab, meta = storePaths(path)
+    if not (npy.exists() and vocab.exists() and meta.exists()):
+        return False
+    with open(meta) as f:
+        info = json.load(f)
+    if info.get('format') != FORMAT:
+        return False
+    if not Path(path).exists():
+        return True  # 変換したものだけを配っている
+    stat = os.stat(path)
+    if not full and stat.st_size == info['size'] and stat.st_mtime == info['mtime']:
+        return True
+    return stat.st_size == info['size'] and fileHash(path) == info['sha256']
+
+
+def load(path):
+    if not verify(path, full=False):
+        return None
+    import numpy as np
+    npy, vocab, meta = storePaths(path)
+    vectors = np.load(npy, mmap_mode='r')
+    with open(vocab, encoding='utf-8') as f:
+        words = f.read().split('\n')[:-1]
+    if len(words) != vectors.shape[0]:
+        log.warning('broken vector store %s', npy)
+        return None
+    return WordVectors(words, vectors)
+
+
+if __name__ == "__main__":
+    command, path = sys.argv[1], sys.argv[2]
+    if command == 'convert':
+        print(json.dumps(convert(path), indent=2))
+    elif command == 'verify':
+        ok = verify(path)
+        print('ok' if ok else 'mismatch')
+        sys.exit(0 if ok else 1)
+
+__package__ = 'wordvec'